@@ -1,15 +1,30 @@
 import streamlit as st
 import streamlit.components.v1 as components
 import pandas as pd
+import numpy as np
 import folium
-from streamlit_folium import st_folium
 import googlemaps
+import requests
+from requests.adapters import HTTPAdapter
 import polyline as polyline_decoder
 from datetime import datetime, date as date_type
 import re
 import os
 import base64
+import hashlib
+import io
 import json
+import copy
+import sqlite3
+import threading
+import time
+import atexit
+import uuid
+import random
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import msgpack
+from PIL import Image
 import firebase_admin
 from firebase_admin import credentials, firestore
 
@@ -51,80 +66,969 @@ def init_firebase():
         firebase_admin.initialize_app(cred)
     return firestore.client()
 
-db = init_firebase()
-
 # --- Firebase 저장/불러오기 함수 ---
-def load_places():
-    doc = db.collection("travel_data").document("places").get()
-    if doc.exists:
-        return doc.to_dict().get("list", [])
-    return []
+# travel_data 컬렉션의 문서 목록 (세션 시작 시 한 번에 불러옴)
+TRAVEL_DOCS = ["places", "itinerary", "flights", "hotels", "budget",
+               "checklist", "restaurants", "transports", "settings"]
 
-def save_places(places):
-    db.collection("travel_data").document("places").set({"list": places})
-
-def load_itinerary():
-    doc = db.collection("travel_data").document("itinerary").get()
-    if doc.exists:
-        rows = doc.to_dict().get("list", [])
-        if rows:
-            df = pd.DataFrame(rows)
-            # 이전 데이터 호환성: '시간' 컬럼이 있으면 '시작시간'으로 변환
-            if '시간' in df.columns and '시작시간' not in df.columns:
-                df = df.rename(columns={'시간': '시작시간'})
-            for col in ['날짜', '종료날짜', '시작시간', '종료시간', '장소 및 활동', '메모']:
-                if col not in df.columns:
-                    df[col] = ''
-            return df[['날짜', '종료날짜', '시작시간', '종료시간', '장소 및 활동', '메모']]
-    return pd.DataFrame(columns=['날짜', '종료날짜', '시작시간', '종료시간', '장소 및 활동', '메모'])
+ITINERARY_COLUMNS = ['날짜', '종료날짜', '시작시간', '종료시간', '장소 및 활동', '메모']
 
-def save_itinerary(df):
-    db.collection("travel_data").document("itinerary").set({"list": df.to_dict(orient="records")})
+# 지출은 월별 원장 문서(budget_ledger_YYYY-MM)에 추가만 하고, budget 문서에는 월별 요약만 둠
+LEDGER_PREFIX = "budget_ledger_"
 
-def load_flights():
-    doc = db.collection("travel_data").document("flights").get()
-    if doc.exists:
-        return doc.to_dict().get("list", [])
-    return []
+# --- 저장소 백엔드 ---
+# 두 백엔드 모두 같은 인터페이스를 가짐:
+#   get_all(doc_ids)  → [(doc_id, data 또는 None, update_time), ...]
+#   get_update_times(doc_ids) → {doc_id: update_time} (내용 없이 메타데이터만, 없는 문서는 빠짐)
+#   commit(writes)    → writes [(doc_id, data, merge), ...] 를 원자적으로 반영, 쓰기별 update_time 목록 반환
+#   watch(doc_ids, on_change) → 다른 곳에서 바뀐 문서를 on_change(doc_id, data, update_time)로 전달
+STORAGE_TIMEOUT_SEC = 10.0  # 신호가 없을 때 오래 붙잡혀 있지 않고 오프라인으로 전환
 
-def save_flights(flights):
-    db.collection("travel_data").document("flights").set({"list": flights})
+class FirestoreStorage:
+    """Firestore travel_data 컬렉션."""
 
-def load_hotels():
-    doc = db.collection("travel_data").document("hotels").get()
-    if doc.exists:
-        return doc.to_dict().get("list", [])
-    return []
+    def __init__(self):
+        self.db = init_firebase()
 
-def save_hotels(hotels):
-    db.collection("travel_data").document("hotels").set({"list": hotels})
-
-def load_budget():
-    """{"planned": {cat: amount}, "expenses": [...]} 형태로 반환. 구 포맷 마이그레이션 포함."""
-    doc = db.collection("travel_data").document("budget").get()
-    if doc.exists:
-        data = doc.to_dict()
-        if "expenses" in data:
-            if "planned" not in data:
-                data["planned"] = {}
-            return data
+    def _ref(self, doc_id):
+        return self.db.collection("travel_data").document(doc_id)
+
+    def get_all(self, doc_ids):
+        return [
+            (snap.id, snap.to_dict() if snap.exists else None, snap.update_time)
+            for snap in self.db.get_all([self._ref(d) for d in doc_ids], timeout=STORAGE_TIMEOUT_SEC)
+        ]
+
+    def get_update_times(self, doc_ids):
+        """문서 내용 없이 update_time만 조회 (문서 이름만 반환하는 프로젝션 쿼리)."""
+        wanted = set(doc_ids)
+        # "__name__" = 문서 ID 필드 (FieldPath.document_id()와 같음, firebase_admin.firestore에는 FieldPath가 없음)
+        query = self.db.collection("travel_data").select(["__name__"])
+        return {snap.id: snap.update_time for snap in query.stream(timeout=STORAGE_TIMEOUT_SEC) if snap.id in wanted}
+
+    def commit(self, writes):
+        batch = self.db.batch()
+        for doc_id, data, merge in writes:
+            batch.set(self._ref(doc_id), data, merge=merge)
+        return [r.update_time for r in batch.commit(timeout=STORAGE_TIMEOUT_SEC)]
+
+    def watch(self, doc_ids, on_change):
+        def _on_snapshot(doc_snapshots, changes, read_time):
+            for snap in doc_snapshots:
+                on_change(snap.id, snap.to_dict() if snap.exists else None, snap.update_time)
+
+        return [self._ref(d).on_snapshot(_on_snapshot) for d in doc_ids]
+
+# SQLite에서 항목별 테이블로 저장하는 목록 문서 (문서ID → 테이블명)
+SQLITE_ITEM_TABLES = {
+    "places": "places",
+    "itinerary": "itinerary_rows",
+    "restaurants": "restaurants",
+}
+SQLITE_LEDGER_TABLE = "expenses"  # 월별 지출 원장 문서는 모두 이 테이블 (doc_id로 구분)
+
+def _sqlite_item_table(doc_id):
+    if doc_id.startswith(LEDGER_PREFIX):
+        return SQLITE_LEDGER_TABLE
+    return SQLITE_ITEM_TABLES.get(doc_id)
+
+class SqliteStorage:
+    """로컬 SQLite(WAL) 파일. 네트워크 없이 한 대의 머신에서 실행/벤치마크할 때 사용.
+    주요 목록은 항목 하나가 한 행인 테이블(위치 인덱스 포함)에, 나머지 필드는 documents 테이블에 JSON으로 저장."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "doc_id TEXT PRIMARY KEY, data TEXT NOT NULL, update_time REAL NOT NULL)"
+        )
+        for table in [*SQLITE_ITEM_TABLES.values(), SQLITE_LEDGER_TABLE]:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "doc_id TEXT NOT NULL, item_id TEXT NOT NULL, pos INTEGER NOT NULL, data TEXT NOT NULL, "
+                "PRIMARY KEY (doc_id, item_id))"
+            )
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_pos ON {table}(doc_id, pos)")
+
+    def _read(self, doc_id):
+        row = self._conn.execute(
+            "SELECT data, update_time FROM documents WHERE doc_id = ?", (doc_id,)
+        ).fetchone()
+        if row is None:
+            return None, None
+        data = json.loads(row[0])
+        table = _sqlite_item_table(doc_id)
+        if table:
+            items_field, order_field = _list_fields(doc_id)
+            rows = self._conn.execute(
+                f"SELECT item_id, data FROM {table} WHERE doc_id = ? ORDER BY pos", (doc_id,)
+            ).fetchall()
+            data[items_field] = {item_id: json.loads(d) for item_id, d in rows}
+            data[order_field] = [item_id for item_id, _ in rows]
+        return data, row[1]
+
+    def get_all(self, doc_ids):
+        with self._lock:
+            return [(d, *self._read(d)) for d in doc_ids]
+
+    def get_update_times(self, doc_ids):
+        marks = ",".join("?" * len(doc_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT doc_id, update_time FROM documents WHERE doc_id IN ({marks})", list(doc_ids)
+            ).fetchall()
+        return dict(rows)
+
+    def _write_items(self, table, doc_id, items_patch, order, merge):
+        """항목 테이블에 반영. 바뀐 항목 행만 INSERT/UPDATE/DELETE."""
+        if not merge:
+            self._conn.execute(f"DELETE FROM {table} WHERE doc_id = ?", (doc_id,))
+        for item_id, value in (items_patch or {}).items():
+            if value is firestore.DELETE_FIELD:
+                self._conn.execute(f"DELETE FROM {table} WHERE doc_id = ? AND item_id = ?", (doc_id, item_id))
+                continue
+            row = self._conn.execute(
+                f"SELECT data FROM {table} WHERE doc_id = ? AND item_id = ?", (doc_id, item_id)
+            ).fetchone()
+            if row is not None:
+                data = _merge_into(json.loads(row[0]), value) if merge else value
+                self._conn.execute(
+                    f"UPDATE {table} SET data = ? WHERE doc_id = ? AND item_id = ?",
+                    (json.dumps(data, ensure_ascii=False, default=str), doc_id, item_id),
+                )
+            else:
+                self._conn.execute(
+                    f"INSERT INTO {table} (doc_id, item_id, pos, data) VALUES "
+                    f"(?, ?, (SELECT COALESCE(MAX(pos), -1) + 1 FROM {table} WHERE doc_id = ?), ?)",
+                    (doc_id, item_id, doc_id, json.dumps(_merge_into({}, value), ensure_ascii=False, default=str)),
+                )
+        if isinstance(order, list):
+            # 순서 전체가 온 경우(재정렬/전체 저장)만 위치 갱신. ArrayUnion/Remove는 위 INSERT/DELETE로 처리됨
+            self._conn.executemany(
+                f"UPDATE {table} SET pos = ? WHERE doc_id = ? AND item_id = ?",
+                [(pos, doc_id, item_id) for pos, item_id in enumerate(order)],
+            )
+
+    def commit(self, writes):
+        update_times = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for doc_id, data, merge in writes:
+                    data = dict(data)
+                    table = _sqlite_item_table(doc_id)
+                    if table:
+                        items_field, order_field = _list_fields(doc_id)
+                        self._write_items(table, doc_id, data.pop(items_field, None),
+                                          data.pop(order_field, None), merge)
+                    row = self._conn.execute(
+                        "SELECT data FROM documents WHERE doc_id = ?", (doc_id,)
+                    ).fetchone()
+                    base = json.loads(row[0]) if (row and merge) else {}
+                    now = time.time()
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO documents (doc_id, data, update_time) VALUES (?, ?, ?)",
+                        (doc_id, json.dumps(_merge_into(base, data), ensure_ascii=False, default=str), now),
+                    )
+                    update_times.append(now)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return update_times
+
+    def watch(self, doc_ids, on_change):
+        # 단일 프로세스 전용: 모든 쓰기가 같은 공유 캐시를 거치므로 별도 감시 불필요
+        return []
+
+def _backend_name():
+    return st.secrets.get("STORAGE_BACKEND", "firestore")
+
+@st.cache_resource
+def _storage():
+    """secrets의 STORAGE_BACKEND("firestore" 기본 / "sqlite")에 따라 백엔드 생성."""
+    if _backend_name() == "sqlite":
+        return SqliteStorage(st.secrets.get("SQLITE_PATH", os.path.join(APP_DIR, "trip.db")))
+    return FirestoreStorage()
+
+# --- 프로세스 전역 문서 캐시 (모든 세션 공유) ---
+def _merge_into(target, patch):
+    """set(merge=True)와 같은 방식으로 patch를 target에 병합.
+    DELETE_FIELD / ArrayUnion / ArrayRemove / Increment 센티널도 Firestore와 같은 의미로 적용."""
+    for k, v in patch.items():
+        if v is firestore.DELETE_FIELD:
+            target.pop(k, None)
+        elif isinstance(v, firestore.ArrayUnion):
+            arr = list(target.get(k) or [])
+            arr.extend(x for x in v.values if x not in arr)
+            target[k] = arr
+        elif isinstance(v, firestore.ArrayRemove):
+            target[k] = [x for x in (target.get(k) or []) if x not in v.values]
+        elif isinstance(v, firestore.Increment):
+            target[k] = (target.get(k) or 0) + v.value
+        elif isinstance(v, dict):
+            if not isinstance(target.get(k), dict):
+                target[k] = {}
+            _merge_into(target[k], v)
+        else:
+            target[k] = copy.deepcopy(v)
+    return target
+
+# --- 로컬 디스크 스냅샷 (msgpack) ---
+# 문서 내용과 update_time을 디스크에 보관해 두고, 시작할 때 메타데이터만 비교해서 바뀐 문서만 get_all로 다시 받음.
+# 대역폭이 실제로 줄어드는 것은 리스너가 없는 백엔드(SQLite)뿐. Firestore는 on_snapshot 리스너의 첫 스냅샷이
+# 지켜보는 문서 전체를 어차피 내려받으므로, 여기서 아끼는 것은 그와 겹치는 get_all 한 번이고 메타데이터 조회 왕복이 더해짐
+LOCAL_CACHE_DIR = os.path.join(APP_DIR, ".trip_cache")  # 스냅샷, 작업 로그, 지도 API 캐시 파일 위치
+SNAPSHOT_SAVE_DELAY_SEC = 2.0  # 변경이 몰릴 때 디스크 쓰기를 묶는 간격
+
+def _pack_time(t):
+    if t is None:
+        return None
+    if isinstance(t, datetime):
+        return ["dt", t.isoformat()]
+    return ["ts", t]
+
+def _unpack_time(v):
+    if v is None:
+        return None
+    return datetime.fromisoformat(v[1]) if v[0] == "dt" else v[1]
+
+class DiskSnapshot:
+    """{doc_id: (update_time, data)}를 msgpack 파일 하나로 저장/로드."""
+
+    def __init__(self, path):
+        self.path = path
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                packed = msgpack.unpackb(f.read(), raw=False)
+        except (OSError, ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError):
+            return {}
+        return {d: (_unpack_time(t), data) for d, (t, data) in packed.items()}
+
+    def save(self, entries):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        packed = msgpack.packb(
+            {d: [_pack_time(t), data] for d, (t, data) in entries.items()},
+            use_bin_type=True, default=str,
+        )
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(packed)
+        os.replace(tmp, self.path)  # 쓰는 도중 종료돼도 이전 파일은 온전함
+
+    def save_later(self, export):
+        """export()가 돌려주는 내용을 잠시 뒤 한 번에 저장 (여러 변경을 묶음)."""
+        with self._lock:
+            if self._timer is not None:
+                return
+            def _run():
+                with self._lock:
+                    self._timer = None
+                try:
+                    self.save(export())
+                except OSError:
+                    pass
+            self._timer = threading.Timer(SNAPSHOT_SAVE_DELAY_SEC, _run)
+            self._timer.daemon = True
+            self._timer.start()
+
+class TripDocCache:
+    """travel_data 문서를 (update_time, data, version)으로 보관하는 버전 저장소.
+    세션에는 항상 복사본을 넘겨주고, 내용이 바뀔 때마다 version이 1씩 증가."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs = {}  # doc_id -> (update_time, data 또는 None, version)
+        self._pending = set()  # 저장 대기/진행 중인 로컬 변경이 있는 문서
+        self._held = {}  # doc_id -> (data, update_time): 저장 대기 중에 받은 서버 스냅샷 (최신 것만)
+        self._unknown = set()  # 오프라인이라 서버 내용을 모른 채 빈 문서로 보여주는 문서
+        self._watched = set(TRAVEL_DOCS)
+        self.watches = []
+        self.disk = None  # DiskSnapshot (설정되면 서버와 일치하는 내용만 디스크에 보관)
+        self.offline = False  # 마지막 읽기가 저장소에 닿지 못해 디스크 사본을 보여주는 중
+
+    def export(self):
+        """서버에 반영된(저장 대기 중이 아닌) 문서만 {doc_id: (update_time, data)}로 반환."""
+        with self._lock:
+            return {
+                d: (t, copy.deepcopy(data))
+                for d, (t, data, _) in self._docs.items()
+                if d not in self._pending and d not in self._unknown
+            }
+
+    def _changed(self):
+        if self.disk is not None:
+            self.disk.save_later(self.export)
+
+    def get_many(self, doc_ids):
+        """(캐시된 {doc_id: data 복사본}, {doc_id: version}, 캐시에 없는 doc_id 목록) 반환."""
+        found, versions, missing = {}, {}, []
+        with self._lock:
+            for doc_id in doc_ids:
+                if doc_id in self._docs:
+                    found[doc_id] = copy.deepcopy(self._docs[doc_id][1])
+                    versions[doc_id] = self._docs[doc_id][2]
+                else:
+                    missing.append(doc_id)
+        return found, versions, missing
+
+    def versions(self, doc_ids):
+        with self._lock:
+            return {d: self._docs[d][2] for d in doc_ids if d in self._docs}
+
+    def put(self, doc_id, data, update_time):
+        """서버 스냅샷 반영. 더 최신(update_time 기준)인 경우에만 교체하고 version 반환.
+        아직 저장되지 않은 로컬 변경이 있는 문서는 덮어쓰지 않고, 스냅샷을 보관했다가 confirm에서 반영."""
+        with self._lock:
+            cached = self._docs.get(doc_id)
+            if cached:
+                if doc_id in self._pending:
+                    held = self._held.get(doc_id)
+                    if held is None or not (held[1] and update_time and held[1] >= update_time):
+                        self._held[doc_id] = (copy.deepcopy(data), update_time)
+                    return cached[2]
+                if cached[0] and update_time and cached[0] >= update_time:
+                    return cached[2]  # 자기 쓰기의 echo 이거나 더 오래된 스냅샷
+                if cached[1] == data:
+                    version = cached[2]  # 내용이 같으면 update_time만 갱신
+                    data = cached[1]
+                else:
+                    version = cached[2] + 1
+                    data = copy.deepcopy(data)
+            else:
+                version = 1
+                data = copy.deepcopy(data)
+            self._docs[doc_id] = (update_time, data, version)
+            self._unknown.discard(doc_id)
+        self._changed()
+        return version
+
+    def put_unknown(self, doc_id):
+        """저장소에도 디스크에도 없어 내용을 모르는 문서 (오프라인). 화면에는 빈 문서로 보이지만
+        이 문서에 대한 저장은 기준 내용 없이 기록되어, 재연결 후 서버에 이미 있는 값은 덮어쓰지 않음."""
+        with self._lock:
+            if doc_id not in self._docs:
+                self._docs[doc_id] = (None, None, 1)
+                self._unknown.add(doc_id)
+
+    def known(self, doc_id):
+        with self._lock:
+            return doc_id not in self._unknown
+
+    def peek(self, doc_id, default=None):
+        """캐시된 내용의 복사본 (캐시에 없으면 default)."""
+        with self._lock:
+            cached = self._docs.get(doc_id)
+            return copy.deepcopy(cached[1]) if cached else default
+
+    def apply_local(self, doc_id, data, merge):
+        """저장 대기 중인 로컬 변경을 바로 반영 (다른 세션에도 즉시 보임). 반영 후 version 반환.
+        merge 저장인데 캐시에 없는 문서는 전체 내용을 모르므로 무시."""
+        with self._lock:
+            cached = self._docs.get(doc_id)
+            if merge:
+                if cached is None:
+                    return None
+                data = _merge_into(copy.deepcopy(cached[1]) or {}, data)
+            else:
+                data = copy.deepcopy(data)
+            version = cached[2] + 1 if cached else 1
+            self._docs[doc_id] = (cached[0] if cached else None, data, version)
+            self._pending.add(doc_id)
+            return version
+
+    def _take_held(self, doc_id, update_time):
+        """저장 대기 중에 받은 스냅샷이 update_time 이후 것이면 (data, update_time), 아니면 None."""
+        held = self._held.pop(doc_id, None)
+        if held and held[1] and update_time and held[1] >= update_time:
+            return held
+        return None
+
+    def confirm(self, doc_id, update_time, merge=False):
+        """대기 중이던 로컬 변경이 모두 서버에 반영됨.
+        merge 저장이면 캐시 내용(이전 내용 + 내 패치)이 서버 문서와 다를 수 있으므로(그 사이 다른 기기의 변경),
+        update_time을 올리지 않고 두어서 뒤이어 오는 서버 스냅샷(echo)이 반영되게 함.
+        대기 중에 이미 받은 같은 시점 이후의 스냅샷이 있으면 그것으로 교체."""
+        with self._lock:
+            self._pending.discard(doc_id)
+            cached = self._docs.get(doc_id)
+            held = self._take_held(doc_id, update_time)
+            if cached and held:
+                self._docs[doc_id] = (held[1], copy.deepcopy(held[0]), cached[2] + (cached[1] != held[0]))
+                self._unknown.discard(doc_id)
+            elif cached and not merge:
+                self._docs[doc_id] = (update_time, cached[1], cached[2])
+        self._changed()
+
+    def reset(self, doc_id, data, update_time):
+        """충돌 정리 후 서버에 실제로 반영된 내용으로 교체 (대기 중 표시도 해제)."""
+        with self._lock:
+            cached = self._docs.get(doc_id)
+            held = self._take_held(doc_id, update_time)
+            if held:
+                data, update_time = held
+            version = (cached[2] + (cached[1] != data)) if cached else 1
+            self._docs[doc_id] = (update_time, copy.deepcopy(data), version)
+            self._pending.discard(doc_id)
+            self._unknown.discard(doc_id)
+        self._changed()
+
+    def ensure_watched(self, doc_ids):
+        """TRAVEL_DOCS 외 문서(월별 원장 등)도 처음 읽을 때 리스너를 붙임."""
+        with self._lock:
+            new = [d for d in doc_ids if d not in self._watched]
+            self._watched.update(new)
+        if new:
+            self.watches += _storage().watch(new, self.put)
+
+    def lacks_field(self, doc_id, field):
+        """문서 내용은 있는데 field가 없으면 True (구 포맷 문서 판별용)."""
+        with self._lock:
+            data = self._docs.get(doc_id, (None, None))[1]
+            return bool(data) and field not in data
+
+@st.cache_resource
+def _trip_cache():
+    cache = TripDocCache()
+    cache.disk = DiskSnapshot(os.path.join(LOCAL_CACHE_DIR, f"{_backend_name()}_snapshot.msgpack"))
+    # 다른 사용자의 변경을 캐시에 실시간 반영 (Firestore는 문서별 on_snapshot 리스너 — 붙을 때 문서 전체를 한 번 받음)
+    cache.watches = _storage().watch(TRAVEL_DOCS, cache.put)
+    return cache
+
+# --- 쓰기 지연(write-behind) 큐 ---
+# 저장 요청은 바로 반환하고, 백그라운드 스레드가 문서별로 모아서 한 번에 커밋
+SAVE_IDLE_SEC = 0.8        # 마지막 변경 후 이만큼 조용하면 저장
+SAVE_MAX_DELAY_SEC = 3.0   # 변경이 계속 들어와도 최대 이 시간 안에는 저장
+SAVE_RETRY_MAX_SEC = 30.0  # 실패 시 재시도 간격 상한 (지수 백오프)
+
+def _copy_patch(value):
+    """패치 복사. Firestore 센티널(DELETE_FIELD 등)은 동일 객체를 유지해야 해서 deepcopy 대신 사용."""
+    if isinstance(value, dict):
+        return {k: _copy_patch(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_patch(v) for v in value]
+    return value
+
+def _is_transform(value):
+    return isinstance(value, (firestore.ArrayUnion, firestore.ArrayRemove, firestore.Increment))
+
+def _combine_patches(a, b):
+    """merge 패치 a 다음 b를 한 번의 set(merge=True)로 합침. 합칠 수 없으면 None."""
+    out = dict(a)
+    for k, v in b.items():
+        if k not in out:
+            out[k] = v
+            continue
+        prev = out[k]
+        if isinstance(prev, dict) and isinstance(v, dict):
+            sub = _combine_patches(prev, v)
+            if sub is None:
+                return None
+            out[k] = sub
+        elif isinstance(prev, firestore.Increment) and isinstance(v, firestore.Increment):
+            out[k] = firestore.Increment(prev.value + v.value)
+        elif _is_transform(prev) and type(prev) is type(v):
+            out[k] = type(v)(list(prev.values) + [x for x in v.values if x not in prev.values])
+        elif _is_transform(v) or (prev is firestore.DELETE_FIELD and isinstance(v, dict)):
+            return None
+        else:
+            out[k] = v
+    return out
+
+# --- 오프라인 작업 로그 ---
+# 모든 저장은 먼저 로컬 SQLite 로그에 순서대로 남기고, 서버 반영이 확인되면 지움.
+# 신호가 없는 동안(또는 프로세스가 재시작돼도) 변경이 보존되고, 재연결되면 한 배치로 다시 보냄.
+_MISSING = object()  # 패치 경로에 값이 없음
+_UNKNOWN = object()  # 변경 당시 문서 내용을 몰랐음 (오프라인에서 처음 연 문서)
+
+def _encode_patch(value):
+    """Firestore 센티널을 JSON으로 저장할 수 있게 태그 dict로 변환."""
+    if value is firestore.DELETE_FIELD:
+        return {"$op": "delete"}
+    if isinstance(value, firestore.ArrayUnion):
+        return {"$op": "union", "values": _encode_patch(list(value.values))}
+    if isinstance(value, firestore.ArrayRemove):
+        return {"$op": "remove", "values": _encode_patch(list(value.values))}
+    if isinstance(value, firestore.Increment):
+        return {"$op": "inc", "value": value.value}
+    if isinstance(value, dict):
+        return {k: _encode_patch(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_encode_patch(v) for v in value]
+    return value
+
+def _decode_patch(value):
+    if isinstance(value, dict):
+        op = value.get("$op")
+        if op == "delete":
+            return firestore.DELETE_FIELD
+        if op == "union":
+            return firestore.ArrayUnion(_decode_patch(value["values"]))
+        if op == "remove":
+            return firestore.ArrayRemove(_decode_patch(value["values"]))
+        if op == "inc":
+            return firestore.Increment(value["value"])
+        return {k: _decode_patch(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode_patch(v) for v in value]
+    return value
+
+def _patch_leaves(patch, path=()):
+    """merge 패치의 (필드 경로, 값) 목록. 비어 있지 않은 dict는 하위 필드로 내려감."""
+    for k, v in patch.items():
+        if isinstance(v, dict) and v:
+            yield from _patch_leaves(v, path + (k,))
+        else:
+            yield path + (k,), v
+
+def _get_path(data, path):
+    for k in path:
+        if not isinstance(data, dict) or k not in data:
+            return _MISSING
+        data = data[k]
+    return data
+
+def _filter_patch(patch, keep, path=()):
+    """keep(경로, 값)이 True인 필드만 남긴 패치. 필드가 모두 빠진 하위 dict는 제거."""
+    out = {}
+    for k, v in patch.items():
+        p = path + (k,)
+        if isinstance(v, dict) and v:
+            sub = _filter_patch(v, keep, p)
+            if sub:
+                out[k] = sub
+        elif keep(p, v):
+            out[k] = v
+    return out
+
+def _diff_patch(base, new):
+    """base를 new로 만드는 merge 패치 (바뀐 필드만, 없어진 필드는 DELETE_FIELD)."""
+    patch = {}
+    for k, v in new.items():
+        if isinstance(v, dict) and isinstance(base.get(k), dict):
+            sub = _diff_patch(base[k], v)
+            if sub:
+                patch[k] = sub
+        elif k not in base or base[k] != v:
+            patch[k] = v
+    for k in base:
+        if k not in new:
+            patch[k] = firestore.DELETE_FIELD
+    return patch
+
+def _epoch(update_time):
+    return update_time.timestamp() if isinstance(update_time, datetime) else float(update_time)
+
+def _resolve_op(data, merge, base, ts, current, update_time):
+    """로그의 변경 하나를 서버 최신 문서(current, update_time)에 맞춰 정리. 어느 기기에서 돌려도 같은 결과:
+    - 서버 문서가 이 변경(ts) 이후로 바뀌지 않았으면 그대로 반영
+    - ArrayUnion / ArrayRemove / Increment는 순서와 무관하므로 항상 반영
+      (이미 서버에 반영된 변경은 재생 전에 기기별 반영 seq(OPLOG_MARKS_DOC)로 걸러내므로 두 번 더해지지 않음)
+    - 그 외 필드는 서버 값이 변경 당시 값(base)과 같으면 반영, 서버에서도 바뀌었으면 더 나중인 서버 값 유지
+    기준 내용 없이 기록된 전체 저장(merge=False)은 그대로 덮어씀.
+    문서 내용을 모른 채 한 변경(base가 None)은 서버에 값이 없는 필드만 반영 (서버 값 우선)."""
+    if base is None:
+        return _filter_patch(data, lambda path, value: _is_transform(value) or _get_path(current, path) is _MISSING)
+    if not merge or update_time is None or _epoch(update_time) <= ts:
+        return data
+
+    def _keep(path, value):
+        return _is_transform(value) or _get_path(current, path) == base.get(path, _MISSING)
+
+    return _filter_patch(data, _keep)
+
+# 기기(로그)별로 서버에 반영된 마지막 seq를 기록하는 문서. 저장과 같은 배치로 커밋되므로,
+# 커밋은 성공했는데 응답을 못 받은 경우에도 재생할 때 이미 반영된 변경(특히 Increment)을 건너뛸 수 있음
+OPLOG_MARKS_DOC = "oplog_marks"
+
+class OpLog:
+    """서버에 아직 반영되지 않은 저장을 순서대로 보관하는 로컬 SQLite 로그."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ops ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, doc_id TEXT NOT NULL, merge INTEGER NOT NULL, "
+            "data TEXT NOT NULL, base TEXT NOT NULL, ts REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('device_id', ?)", (uuid.uuid4().hex,))
+        self.device_id = self._conn.execute("SELECT value FROM meta WHERE key = 'device_id'").fetchone()[0]
+
+    def mark_write(self, upto):
+        """seq <= upto 까지 반영됐다는 표시 (저장과 같은 배치에 넣는 쓰기)."""
+        return (OPLOG_MARKS_DOC, {self.device_id: upto}, True)
+
+    def append(self, doc_id, data, merge, current):
+        """변경 기록 후 seq 반환. current는 변경 직전 캐시 내용 (캐시에 없으면 _MISSING, 내용을 모르면 _UNKNOWN).
+        전체 저장은 current와의 차이만 merge 패치로 남겨서, 나중에 다시 보낼 때 다른 필드를 덮어쓰지 않게 함."""
+        if current is _UNKNOWN:
+            # 기준 내용 없이 merge 패치로만 남김 (base None → 재생 시 서버 값 우선)
+            data, merge = (data if merge else _diff_patch({}, data)), True
+        elif not merge and current is not _MISSING:
+            data, merge = _diff_patch(current or {}, data), True
+        base = None if current is _UNKNOWN else []
+        if merge and base is not None:
+            for path, _ in _patch_leaves(data):
+                value = _get_path(current, path)
+                if value is not _MISSING:
+                    base.append([list(path), value])
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO ops (doc_id, merge, data, base, ts) VALUES (?, ?, ?, ?, ?)",
+                (doc_id, int(merge), json.dumps(_encode_patch(data), ensure_ascii=False, default=str),
+                 json.dumps(base, ensure_ascii=False, default=str), time.time()),
+            )
+            return cur.lastrowid
+
+    def read(self, upto=None):
+        """[(seq, doc_id, data, merge, base, ts), ...] (seq 순). base는 {필드 경로 tuple: 변경 전 값}
+        (문서 내용을 모른 채 기록된 변경이면 None)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, doc_id, data, merge, base, ts FROM ops WHERE seq <= ? ORDER BY seq",
+                (upto if upto is not None else 2 ** 62,),
+            ).fetchall()
+        return [
+            (seq, doc_id, _decode_patch(json.loads(data)), bool(merge),
+             None if base == "null" else {tuple(p): v for p, v in json.loads(base)}, ts)
+            for seq, doc_id, data, merge, base, ts in rows
+        ]
+
+    def ack(self, upto):
+        with self._lock:
+            self._conn.execute("DELETE FROM ops WHERE seq <= ?", (upto,))
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM ops").fetchone()[0]
+
+class WriteBehindQueue:
+    """문서별 저장 대기열. 연속된 변경은 합쳐서(coalescing) 한 배치로 커밋하고 실패하면 재시도.
+    모든 변경은 OpLog에도 남겨서, 실패(오프라인)한 뒤에는 로그를 서버 최신 상태와 맞춰 다시 보냄."""
+
+    def __init__(self, cache, log):
+        self._cache = cache
+        self._log = log
+        self._cond = threading.Condition()
+        self._pending = {}  # doc_id -> [(data, merge), ...] (순서대로 적용)
+        self._log_seq = 0  # 대기열에 들어온 마지막 로그 seq
+        self._recovering = False  # True면 다음 커밋은 로그 재생(_replay)으로
+        self._first_at = None
+        self._last_at = None
+        self._failures = 0
+        self._retry_at = None
+        self.last_error = None
+        self._restore()
+        threading.Thread(target=self._run, name="trip-write-behind", daemon=True).start()
+
+    def _restore(self):
+        """이전 실행에서 서버에 못 보낸 변경을 캐시에 다시 반영하고 재생을 예약."""
+        ops = self._log.read()
+        if not ops:
+            return
+        _fetch_into_cache(self._cache, list(dict.fromkeys(op[1] for op in ops)))
+        for _, doc_id, data, merge, _, _ in ops:
+            self._cache.apply_local(doc_id, data, merge)
+            self._stage(doc_id, data, merge)
+        self._log_seq = ops[-1][0]
+        self._recovering = True
+
+    def _stage(self, doc_id, data, merge):
+        writes = self._pending.setdefault(doc_id, [])
+        if not merge:
+            writes[:] = [(data, False)]
+        elif writes and not writes[-1][1]:
+            # 대기 중인 전체 저장에 병합하면 여전히 전체 저장 한 번
+            writes[-1] = (_merge_into(copy.deepcopy(writes[-1][0]), data), False)
+        elif writes and (combined := _combine_patches(writes[-1][0], data)) is not None:
+            writes[-1] = (combined, True)
+        else:
+            writes.append((data, True))
+        now = time.monotonic()
+        self._first_at = self._first_at or now
+        self._last_at = now
+
+    def enqueue(self, doc_id, data, merge=False):
+        """로컬 로그에 기록하고 캐시에 즉시 반영한 뒤 저장을 예약. 반영된 version 반환."""
+        data = _copy_patch(data)
+        if merge and self._cache.peek(doc_id, _MISSING) is _MISSING:
+            # 캐시에 없는 문서(처음 쓰는 월별 원장 등)는 먼저 읽어 둠. 그래야 패치가 캐시에 반영되고
+            # 저장 대기로 표시되어, 커밋 전에 다시 읽은 옛 서버 내용이 캐시에 남지 않음
+            _fetch_into_cache(self._cache, [doc_id])
+        with self._cond:
+            if self._cache.known(doc_id):
+                current = self._cache.peek(doc_id, _MISSING)
+            else:
+                # 서버 내용을 모르는 문서는 바로 커밋하지 않고 서버 최신 내용과 맞춰 보냄 (_replay)
+                current = _UNKNOWN
+                self._recovering = True
+            self._log_seq = self._log.append(doc_id, data, merge, current)
+            version = self._cache.apply_local(doc_id, data, merge)
+            self._stage(doc_id, data, merge)
+            self._cond.notify()
+        return version
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._pending)
+
+    def queued_ops(self):
+        """서버 반영을 기다리는 로그 항목 수."""
+        return self._log.count()
+
+    def _take(self):
+        items, self._pending = self._pending, {}
+        self._first_at = self._last_at = None
+        return items, self._log_seq, self._recovering
+
+    def _send(self, items, upto, recovering):
+        if recovering:
+            self._replay(items, upto)
+        else:
+            self._commit(items, upto)
+
+    def flush(self):
+        """대기 중인 변경을 지금 바로 커밋 (프로세스 종료 시 사용). 실패해도 로그에 남음."""
+        with self._cond:
+            items, upto, recovering = self._take()
+        if items:
+            self._send(items, upto, recovering)
+
+    def _due_at(self):
+        if not self._pending:
+            return None
+        due = min(self._last_at + SAVE_IDLE_SEC, self._first_at + SAVE_MAX_DELAY_SEC)
+        return max(due, self._retry_at) if self._retry_at else due
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    due = self._due_at()
+                    now = time.monotonic()
+                    if due is not None and now >= due:
+                        break
+                    self._cond.wait(None if due is None else due - now)
+                items, upto, recovering = self._take()
+            self._send(items, upto, recovering)
+
+    def _failed(self, items, error):
+        with self._cond:
+            # 실패한 변경을 새로 들어온 변경보다 앞에 다시 넣고 백오프 후 재시도 (다음 시도는 로그 재생)
+            for doc_id, writes in items.items():
+                self._pending[doc_id] = writes + self._pending.get(doc_id, [])
+            self._recovering = True
+            self._cache.offline = True
+            self._failures += 1
+            self.last_error = str(error)
+            self._retry_at = time.monotonic() + min(2 ** self._failures, SAVE_RETRY_MAX_SEC)
+            now = time.monotonic()
+            self._first_at = self._first_at or now
+            self._last_at = self._last_at or now
+
+    def _succeeded(self, upto):
+        self._log.ack(upto)
+        self._recovering = False
+        self._cache.offline = False
+        self._failures = 0
+        self._retry_at = None
+        self.last_error = None
+
+    def _commit(self, items, upto):
+        writes = [(doc_id, data, merge) for doc_id, ws in items.items() for data, merge in ws]
+        try:
+            results = _storage().commit(writes + [self._log.mark_write(upto)])
+        except Exception as e:
+            self._failed(items, e)
+            return
+        with self._cond:
+            self._succeeded(upto)
+            # 문서별 마지막 쓰기의 시각과 merge 여부 (전체 저장이면 캐시 내용이 곧 서버 내용)
+            last = {doc_id: (update_time, merge) for (doc_id, _, merge), update_time in zip(writes, results)}
+            for doc_id, (update_time, merge) in last.items():
+                if doc_id not in self._pending:
+                    self._cache.confirm(doc_id, update_time, merge)
+
+    def _replay(self, items, upto):
+        """재연결 후 로그(seq <= upto)를 서버 최신 문서와 맞춰(_resolve_op) 한 배치로 반영."""
+        ops = self._log.read(upto)
+        try:
+            doc_ids = list(dict.fromkeys(op[1] for op in ops))
+            server = {d: [data, t] for d, data, t in _storage().get_all(doc_ids + [OPLOG_MARKS_DOC])}
+            # 응답을 못 받았지만 실제로는 커밋된 변경은 다시 보내지 않음
+            applied = (server.pop(OPLOG_MARKS_DOC)[0] or {}).get(self._log.device_id, 0)
+            by_doc = {}  # doc_id -> [(patch, merge), ...] (가능하면 하나로 합침)
+            for seq, doc_id, data, merge, base, ts in ops:
+                if seq <= applied:
+                    continue
+                current = server[doc_id][0]
+                patch = _resolve_op(data, merge, base, ts, current, server[doc_id][1])
+                if merge and not patch:
+                    continue
+                server[doc_id][0] = _merge_into(copy.deepcopy(current) or {}, patch) if merge else copy.deepcopy(patch)
+                writes = by_doc.setdefault(doc_id, [])
+                if merge and writes and writes[-1][1] and (combined := _combine_patches(writes[-1][0], patch)) is not None:
+                    writes[-1] = (combined, True)
+                else:
+                    writes.append((patch, merge))
+            writes = [(doc_id, data, merge) for doc_id, ws in by_doc.items() for data, merge in ws]
+            results = _storage().commit(writes + [self._log.mark_write(upto)]) if writes else []
+        except Exception as e:
+            self._failed(items, e)
+            return
+        with self._cond:
+            self._succeeded(upto)
+            for (doc_id, _, _), update_time in zip(writes, results):
+                server[doc_id][1] = update_time
+            for doc_id, (data, update_time) in server.items():
+                if doc_id not in self._pending:
+                    self._cache.reset(doc_id, data, update_time)
+
+@st.cache_resource
+def _write_queue():
+    queue = WriteBehindQueue(_trip_cache(), OpLog(os.path.join(LOCAL_CACHE_DIR, f"{_backend_name()}_oplog.db")))
+    atexit.register(queue.flush)
+    return queue
+
+def _write_doc(doc_id, data, merge=False):
+    """저장 예약 후 바로 반환. 공유 캐시는 즉시 같은 내용으로 갱신 (write-behind).
+    내가 쓴 변경으로 이 세션이 다시 동기화되지 않도록 본 버전도 함께 기록."""
+    version = _write_queue().enqueue(doc_id, data, merge=merge)
+    if version is not None:
+        st.session_state.setdefault('_doc_versions', {})[doc_id] = version
+
+# --- 목록 문서 포맷 ---
+# 목록은 {"items": {id: 항목}, "order": [id, ...]} 로 저장해서
+# 추가/수정/삭제 시 바뀐 항목만 보낼 수 있게 함 (예산 지출은 expense_items/expense_order)
+_LIST_FIELDS = {"budget": ("expense_items", "expense_order")}
+
+def _list_fields(doc_id):
+    return _LIST_FIELDS.get(doc_id, ("items", "order"))
+
+def _new_item_id():
+    return uuid.uuid4().hex[:12]
+
+def _items_from_doc(data, items_field="items", order_field="order", legacy_field="list"):
+    """저장된 목록을 순서대로 된 항목 리스트로 변환. 구 포맷(list 배열)은 위치 기반 id 부여."""
+    if data is None:
+        return []
+    if items_field in data:
+        items = data.get(items_field) or {}
+        order = [i for i in data.get(order_field, []) if i in items]
+        order += [i for i in items if i not in order]
+        return [dict(items[i], id=i) for i in order]
+    # 구 포맷: 세션마다 같은 id가 나오도록 위치 기반 id 사용
+    return [dict(x, id=x.get('id') or f"L{i}") for i, x in enumerate(data.get(legacy_field) or [])]
+
+def _encode_items(items, items_field="items", order_field="order"):
+    return {
+        items_field: {x['id']: {k: v for k, v in x.items() if k != 'id'} for x in items},
+        order_field: [x['id'] for x in items],
+    }
+
+# --- 문서 디코딩 (data: 문서 dict, 문서가 없으면 None) ---
+def _decode_list(data):
+    return _items_from_doc(data)
+
+# 날짜/시간 필드: 비었거나 형식이 맞지 않으면 원래 문자열을 '_원본'에 보관해서 저장할 때 그대로 돌려줌
+_ITINERARY_TIME_FIELDS = ['날짜', '종료날짜', '시작시간', '종료시간']
+
+def _itinerary_frame(rows, index):
+    """저장용 문자열 레코드 → 타입이 있는 일정 DataFrame. 불러올 때 한 번만 파싱함.
+    시작/종료: datetime64, 종료날짜: 여러 날 일정일 때만 값이 있고 아니면 NaT, 텍스트: string.
+    시간이 비어 있으면 정렬용으로 자정을 쓰되, 빈 시간·해석 못 한 날짜는 '_원본'({필드: 문자열})에 남김."""
+    raw = pd.DataFrame(rows, index=index, columns=ITINERARY_COLUMNS).fillna('').astype(str)
+    start_date = pd.to_datetime(raw['날짜'], format='%Y-%m-%d', errors='coerce')
+    end_date = pd.to_datetime(raw['종료날짜'], format='%Y-%m-%d', errors='coerce')
+    start_time = pd.to_timedelta(raw['시작시간'] + ':00', errors='coerce')
+    end_time = pd.to_timedelta(raw['종료시간'] + ':00', errors='coerce')
+    # 다시 저장했을 때 같은 문자열이 나오지 않는 필드 (빈 종료날짜는 원래 빈 값으로 저장되므로 제외,
+    # 날짜가 없으면 시간도 시작/종료에 담기지 않음)
+    unparsed = pd.DataFrame({
+        '날짜': start_date.isna(),
+        '종료날짜': end_date.isna() & (raw['종료날짜'] != ''),
+        '시작시간': start_time.isna() | start_date.isna(),
+        '종료시간': end_time.isna() | end_date.fillna(start_date).isna(),
+    }, index=index)
+    original = [
+        {f: raw.at[i, f] for f in _ITINERARY_TIME_FIELDS if flags[f]} or None
+        for i, flags in unparsed.iterrows()
+    ] if unparsed.to_numpy().any() else [None] * len(raw)
+    return pd.DataFrame({
+        '시작': start_date + start_time.fillna(pd.Timedelta(0)),
+        '종료': end_date.fillna(start_date) + end_time.fillna(pd.Timedelta(0)),
+        '종료날짜': end_date.where(end_date != start_date),
+        '장소 및 활동': raw['장소 및 활동'].astype('string'),
+        '메모': raw['메모'].astype('string'),
+        '_원본': pd.Series(original, index=index, dtype=object),
+    }, index=index)
+
+def _itinerary_strings(df):
+    """타입 있는 일정 → 저장/내보내기용 문자열 컬럼 (ITINERARY_COLUMNS, 벡터 연산).
+    '_원본'에 남은 필드는 불러온 문자열 그대로 (빈 시간은 빈 값, 해석 못 한 날짜는 원래 값)."""
+    out = pd.DataFrame({
+        '날짜': df['시작'].dt.strftime('%Y-%m-%d'),
+        '종료날짜': df['종료날짜'].dt.strftime('%Y-%m-%d'),
+        '시작시간': df['시작'].dt.strftime('%H:%M'),
+        '종료시간': df['종료'].dt.strftime('%H:%M'),
+        '장소 및 활동': df['장소 및 활동'].astype(object),
+        '메모': df['메모'].astype(object),
+    }, index=df.index).fillna('')
+    original = df['_원본'].dropna()
+    for idx, fields in original.items():
+        for field, value in fields.items():
+            out.at[idx, field] = value
+    return out
+
+def _decode_itinerary(data):
+    """타입 있는 일정 DataFrame 반환. 인덱스는 항목 id (삭제해도 바뀌지 않음)."""
+    rows = _items_from_doc(data)
+    for r in rows:
+        # 이전 데이터 호환성: '시간' 필드가 있으면 '시작시간'으로 변환
+        if '시간' in r and '시작시간' not in r:
+            r['시작시간'] = r.pop('시간')
+    return _itinerary_frame(rows, [r['id'] for r in rows])
+
+def _decode_budget(data):
+    """{"planned": {cat: amount}, "ledger_summary": {월: 요약}, "expenses": [...]} 형태로 반환.
+    expenses는 아직 월별 원장으로 옮기지 않은 구 포맷 지출만 담김 (세션 시작 시 이전됨)."""
+    if data is not None:
+        if "expense_items" in data or "expenses" in data or "ledger_summary" in data:
+            return {
+                "planned": data.get("planned", {}),
+                "ledger_summary": data.get("ledger_summary", {}),
+                "expenses": _items_from_doc(data, "expense_items", "expense_order", "expenses"),
+            }
         # 구 포맷 마이그레이션: {"data": {cat: {planned, actual}}} → 새 포맷
         old = data.get("data", {})
         planned = {}
         for cat in BUDGET_CATEGORIES:
             entry = old.get(cat, {})
             planned[cat] = entry.get("planned", 0) if isinstance(entry, dict) else 0
-        return {"planned": planned, "expenses": []}
-    return {"planned": {cat: 0 for cat in BUDGET_CATEGORIES}, "expenses": []}
+        return {"planned": planned, "ledger_summary": {}, "expenses": []}
+    return {"planned": {cat: 0 for cat in BUDGET_CATEGORIES}, "ledger_summary": {}, "expenses": []}
 
-def save_budget(budget_data):
-    db.collection("travel_data").document("budget").set(budget_data)
+def _decode_ledger(data):
+    """월별 원장 → (유효한 지출 목록, 취소 기록 수). 취소 기록은 {"void": 지출 id}."""
+    entries = _items_from_doc(data)
+    voided = {e["void"] for e in entries if "void" in e}
+    live = [e for e in entries if "void" not in e and e["id"] not in voided]
+    return live, len(voided)
 
-def load_checklist():
+def _decode_checklist(data):
     """(soya_list, byungha_list) 튜플 반환. 구 포맷도 마이그레이션."""
-    doc = db.collection("travel_data").document("checklist").get()
-    if doc.exists:
-        data = doc.to_dict()
+    if data is not None:
         if "쏘야" in data or "병하" in data:
             return data.get("쏘야", []), data.get("병하", [])
         # 구 포맷 마이그레이션: 기존 list → 병하에 할당, 쏘야는 기본값
@@ -134,47 +1038,1143 @@ def load_checklist():
     default = [dict(x) for x in DEFAULT_CHECKLIST]
     return list(default), list(default)
 
+def _decode_settings(data):
+    return data if data is not None else {}
+
+_DECODERS = {
+    "places": _decode_list,
+    "itinerary": _decode_itinerary,
+    "flights": _decode_list,
+    "hotels": _decode_list,
+    "budget": _decode_budget,
+    "checklist": _decode_checklist,
+    "restaurants": _decode_list,
+    "transports": _decode_list,
+    "settings": _decode_settings,
+}
+
+def _decoder_for(doc_id):
+    if doc_id.startswith(LEDGER_PREFIX):
+        return _decode_ledger
+    return _DECODERS[doc_id]
+
+def _restore_from_disk(cache, doc_ids):
+    """디스크 스냅샷 중 서버 update_time과 같은 문서를 캐시에 올리고, 다시 받아야 할 doc_id 목록 반환.
+    (Firestore에서는 리스너도 문서 전체를 받으므로 내려받는 양 자체가 줄지는 않음 — 위 '로컬 디스크 스냅샷' 참고)"""
+    disk = cache.disk.load() if cache.disk is not None else {}
+    candidates = [d for d in doc_ids if d in disk]
+    if not candidates:
+        return list(doc_ids)
+    server_times = _storage().get_update_times(candidates)
+    stale = [d for d in doc_ids if d not in candidates]
+    for doc_id in candidates:
+        update_time, data = disk[doc_id]
+        if server_times.get(doc_id) == update_time:
+            cache.put(doc_id, data, update_time)
+        else:
+            stale.append(doc_id)
+    return stale
+
+def _fetch_into_cache(cache, doc_ids):
+    """캐시에 없는 문서를 디스크 스냅샷/저장소에서 채움.
+    저장소에 닿지 않으면(오프라인) 디스크 사본을 검증 없이 그대로 씀 — 리스너가 다시 연결되면 최신으로 교체됨.
+    디스크 사본도 없는 문서는 내용을 모르는 문서(put_unknown)로 둠."""
+    _, _, missing = cache.get_many(doc_ids)
+    if not missing:
+        return
+    try:
+        stale = _restore_from_disk(cache, missing)
+        if stale:
+            for doc_id, data, update_time in _storage().get_all(stale):
+                cache.put(doc_id, data, update_time)
+        cache.offline = False
+    except Exception:
+        cache.offline = True
+        disk = cache.disk.load() if cache.disk is not None else {}
+        for doc_id in cache.get_many(missing)[2]:
+            if doc_id in disk:
+                update_time, data = disk[doc_id]
+                cache.put(doc_id, data, update_time)
+            else:
+                cache.put_unknown(doc_id)
+
+def load_trip_snapshot(doc_ids=TRAVEL_DOCS):
+    """travel_data 문서를 ({문서ID: 디코딩 결과}, {문서ID: version})으로 반환.
+    공유 캐시 → 디스크 스냅샷(메타데이터만 확인) → get_all 배치 읽기 순으로, get_all은 바뀐 문서만 요청.
+    Firestore는 리스너의 첫 스냅샷이 문서 전체를 따로 받으므로 전체 전송량이 줄어드는 것은 리스너 없는 백엔드뿐."""
+    cache = _trip_cache()
+    raw, versions, missing = cache.get_many(doc_ids)
+    if missing:
+        _fetch_into_cache(cache, missing)
+        found, found_versions, _ = cache.get_many(missing)
+        raw.update(found)
+        versions.update(found_versions)
+    return {d: _decoder_for(d)(raw.get(d)) for d in doc_ids}, versions
+
+def save_places(places):
+    _write_doc("places", _encode_items(places))
+
+def _itinerary_record(df, idx):
+    return _itinerary_strings(df.loc[[idx]]).iloc[0].to_dict()
+
+def save_itinerary(df):
+    records = _itinerary_strings(df).to_dict(orient="index")
+    _write_doc("itinerary", _encode_items([dict(r, id=idx) for idx, r in records.items()]))
+
+def save_flights(flights):
+    _write_doc("flights", _encode_items(flights))
+
+def save_hotels(hotels):
+    _write_doc("hotels", _encode_items(hotels))
+
+def save_budget(budget_data):
+    """계획 예산과 월별 요약만 저장 (지출 내역은 월별 원장 문서에 있음)."""
+    _write_doc("budget", {
+        "planned": budget_data.get("planned", {}),
+        "ledger_summary": budget_data.get("ledger_summary", {}),
+    })
+
 def save_checklist(person, items):
     """person 키만 업데이트 (merge=True 사용)."""
-    db.collection("travel_data").document("checklist").set(
-        {person: items}, merge=True
-    )
-
-def load_restaurants():
-    doc = db.collection("travel_data").document("restaurants").get()
-    if doc.exists:
-        return doc.to_dict().get("list", [])
-    return []
+    _write_doc("checklist", {person: items}, merge=True)
 
 def save_restaurants(restaurants):
-    db.collection("travel_data").document("restaurants").set({"list": restaurants})
-
-def load_transports():
-    doc = db.collection("travel_data").document("transports").get()
-    if doc.exists:
-        return doc.to_dict().get("list", [])
-    return []
+    _write_doc("restaurants", _encode_items(restaurants))
 
 def save_transports(transports):
-    db.collection("travel_data").document("transports").set({"list": transports})
-
-def load_settings():
-    doc = db.collection("travel_data").document("settings").get()
-    if doc.exists:
-        return doc.to_dict()
-    return {}
+    _write_doc("transports", _encode_items(transports))
 
 def save_settings(settings):
-    db.collection("travel_data").document("settings").set(settings)
+    _write_doc("settings", settings)
+
+# --- 변경분(delta) 저장: 바뀐 항목만 set(merge=True)로 전송 ---
+_FULL_SAVERS = {
+    "places": lambda: save_places(st.session_state['places']),
+    "itinerary": lambda: save_itinerary(st.session_state['itinerary']),
+    "flights": lambda: save_flights(st.session_state['flights']),
+    "hotels": lambda: save_hotels(st.session_state['hotels']),
+    "restaurants": lambda: save_restaurants(st.session_state['restaurants']),
+    "transports": lambda: save_transports(st.session_state['transports']),
+}
+
+def _write_delta(doc_id, patch):
+    """patch만 병합 저장. 아직 구 포맷인 문서는 한 번 전체 저장으로 새 포맷 전환."""
+    if _trip_cache().lacks_field(doc_id, _list_fields(doc_id)[0]):
+        _FULL_SAVERS[doc_id]()
+    else:
+        _write_doc(doc_id, patch, merge=True)
+
+def save_item_added(doc_id, item):
+    """이미 세션 목록에 추가된 item 하나만 저장 (id가 없으면 새로 부여)."""
+    item.setdefault('id', _new_item_id())
+    items_field, order_field = _list_fields(doc_id)
+    _write_delta(doc_id, {
+        items_field: {item['id']: {k: v for k, v in item.items() if k != 'id'}},
+        order_field: firestore.ArrayUnion([item['id']]),
+    })
+
+def save_item_updated(doc_id, item_id, fields):
+    """항목의 일부 필드만 저장."""
+    _write_delta(doc_id, {_list_fields(doc_id)[0]: {item_id: dict(fields)}})
+
+def save_items_reordered(doc_id, items):
+    """항목 내용은 그대로 두고 순서만 저장."""
+    _write_delta(doc_id, {_list_fields(doc_id)[1]: [x['id'] for x in items]})
+
+def save_item_removed(doc_id, item_id):
+    items_field, order_field = _list_fields(doc_id)
+    _write_delta(doc_id, {
+        items_field: {item_id: firestore.DELETE_FIELD},
+        order_field: firestore.ArrayRemove([item_id]),
+    })
+
+# --- 지출 원장 (월별 샤드, 추가 전용) ---
+LEDGER_COMPACT_VOIDS = 20  # 취소 기록이 이만큼 쌓이면 해당 월 원장을 압축
+
+def _ledger_doc_id(month):
+    return f"{LEDGER_PREFIX}{month}"
+
+def _expense_month(expense):
+    return str(expense.get("date", ""))[:7] or "unknown"
+
+def _summarize_expenses(expenses):
+    summary = {"count": 0, "total": 0, "by_category": {}, "by_person": {}}
+    for e in expenses:
+        amount = int(e.get("amount", 0))
+        summary["count"] += 1
+        summary["total"] += amount
+        cat, person = e.get("category", ""), e.get("person", "")
+        summary["by_category"][cat] = summary["by_category"].get(cat, 0) + amount
+        summary["by_person"][person] = summary["by_person"].get(person, 0) + amount
+    return summary
+
+def _summary_increment(expense, sign):
+    amount = sign * int(expense.get("amount", 0))
+    return {
+        "count": firestore.Increment(sign),
+        "total": firestore.Increment(amount),
+        "by_category": {expense.get("category", ""): firestore.Increment(amount)},
+        "by_person": {expense.get("person", ""): firestore.Increment(amount)},
+    }
+
+def _update_ledger_summary(budget, month, patch):
+    """월별 요약을 세션과 저장소에 같은 패치로 반영 (Increment라 동시 수정에도 안전)."""
+    _merge_into(budget.setdefault("ledger_summary", {}), {month: patch})
+    _write_doc("budget", {"ledger_summary": {month: patch}}, merge=True)
+
+def ledger_totals(summary):
+    """월별 요약을 합쳐 전체 {"total", "by_category", "by_person"} 반환."""
+    totals = {"total": 0, "by_category": {}, "by_person": {}}
+    for s in summary.values():
+        totals["total"] += s.get("total", 0)
+        for key in ("by_category", "by_person"):
+            for k, v in s.get(key, {}).items():
+                totals[key][k] = totals[key].get(k, 0) + v
+    return totals
+
+def ledger_months(summary):
+    return sorted(m for m, s in summary.items() if s.get("count", 0) > 0)
+
+def load_ledger(month):
+    """한 달치 원장만 읽어서 유효한 지출 목록 반환 (공유 캐시 사용)."""
+    doc_id = _ledger_doc_id(month)
+    decoded, versions = load_trip_snapshot([doc_id])
+    _trip_cache().ensure_watched([doc_id])
+    st.session_state.setdefault('_doc_versions', {}).update(versions)
+    return decoded[doc_id][0]
+
+def add_expense(budget, expense):
+    """원장에 지출 한 건 추가 + 해당 월 요약 증가."""
+    expense['id'] = _new_item_id()
+    month = _expense_month(expense)
+    _write_doc(_ledger_doc_id(month), {
+        "items": {expense['id']: {k: v for k, v in expense.items() if k != 'id'}},
+        "order": firestore.ArrayUnion([expense['id']]),
+    }, merge=True)
+    _update_ledger_summary(budget, month, _summary_increment(expense, 1))
+
+def void_expense(budget, expense):
+    """원장은 수정하지 않고 취소 기록을 추가 + 요약 감소. 취소가 많이 쌓이면 압축."""
+    month = _expense_month(expense)
+    doc_id = _ledger_doc_id(month)
+    void_id = _new_item_id()
+    _write_doc(doc_id, {
+        "items": {void_id: {"void": expense['id']}},
+        "order": firestore.ArrayUnion([void_id]),
+    }, merge=True)
+    _update_ledger_summary(budget, month, _summary_increment(expense, -1))
+    decoded, _ = load_trip_snapshot([doc_id])
+    if decoded[doc_id][1] >= LEDGER_COMPACT_VOIDS:
+        compact_ledger(month)
+
+def compact_ledger(month):
+    """취소된 지출과 취소 기록만 원장에서 지움. 필드 삭제 + ArrayRemove merge 저장이라
+    그사이 다른 기기가 추가/취소한 항목은 그대로 남음. 월 요약은 추가/취소 때 Increment로 이미 맞춰져 있어 건드리지 않음."""
+    doc_id = _ledger_doc_id(month)
+    load_trip_snapshot([doc_id])
+    entries = _items_from_doc(_trip_cache().peek(doc_id))
+    voided = {e["void"] for e in entries if "void" in e}
+    removed = [e["id"] for e in entries if "void" in e or e["id"] in voided]
+    if removed:
+        _write_doc(doc_id, {
+            "items": {item_id: firestore.DELETE_FIELD for item_id in removed},
+            "order": firestore.ArrayRemove(removed),
+        }, merge=True)
+
+def migrate_expenses_to_ledger(budget):
+    """budget 문서 안에 있던 지출 목록을 월별 원장으로 옮기고 요약 생성 (한 번만 실행됨)."""
+    by_month = {}
+    for e in budget.pop("expenses", []):
+        by_month.setdefault(_expense_month(e), []).append(e)
+    for month, entries in by_month.items():
+        _write_doc(_ledger_doc_id(month), _encode_items(entries))
+        budget.setdefault("ledger_summary", {})[month] = _summarize_expenses(entries)
+    save_budget(budget)
 
 # --- Google Maps 초기화 ---
+MAPS_TIMEOUT_SEC = 5.0    # 요청 하나의 연결/응답 제한
+MAPS_DEADLINE_SEC = 12.0  # 재시도를 포함한 호출 하나의 전체 제한
+
+# MAPS_MODE: "live"(기본) / "record"(실제 호출 + 응답을 fixture로 저장) / "replay"(fixture만 사용, 키/네트워크 불필요)
+MAPS_MODE = st.secrets.get("MAPS_MODE", "live")
+MAPS_FIXTURE_DIR = st.secrets.get("MAPS_FIXTURE_DIR", os.path.join(APP_DIR, "fixtures", "maps"))
+# 요청마다 달라지는 인자는 fixture 키에서 제외
+_FIXTURE_IGNORED_KWARGS = {"departure_time", "session_token"}
+
+def _fixture_path(directory, method, args, kwargs):
+    key = json.dumps(
+        [args, {k: v for k, v in kwargs.items() if k not in _FIXTURE_IGNORED_KWARGS}],
+        sort_keys=True, ensure_ascii=False, default=str,
+    )
+    return os.path.join(directory, method, hashlib.sha1(key.encode()).hexdigest()[:16] + ".json")
+
+def _json_args(args, kwargs):
+    """fixture 파일에 남길 수 있는 형태로 (tuple → list 등)."""
+    return json.loads(json.dumps([args, kwargs], ensure_ascii=False, default=str))
+
+class RecordingMapsClient:
+    """실제 클라이언트를 그대로 호출하면서 응답을 fixture 파일로 저장 (메서드 이름은 원래 클라이언트와 같음)."""
+
+    def __init__(self, client, directory):
+        self._client = client
+        self._directory = directory
+
+    def __getattr__(self, method):
+        target = getattr(self._client, method)
+
+        def call(*args, **kwargs):
+            response = target(*args, **kwargs)
+            if method == "places_photo":
+                response = [b"".join(response)]  # 스트림은 한 번만 읽을 수 있어서 bytes로 모아 둠
+                stored = base64.b64encode(response[0]).decode("ascii")
+            else:
+                stored = response
+            path = _fixture_path(self._directory, method, args, kwargs)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"method": method, "request": _json_args(args, kwargs), "response": stored},
+                          f, ensure_ascii=False, indent=1, default=str)
+            return response
+
+        call.__name__ = method
+        return call
+
+class ReplayMapsClient:
+    """RecordingMapsClient가 저장한 fixture로 응답. 호출마다 latency_ms만큼 지연해서 실제와 비슷한 조건으로 측정."""
+
+    def __init__(self, directory, latency_ms=0):
+        self._directory = directory
+        self._latency = float(latency_ms) / 1000
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            if self._latency:
+                time.sleep(self._latency)
+            path = _fixture_path(self._directory, method, args, kwargs)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    response = json.load(f)["response"]
+            except FileNotFoundError:
+                raise googlemaps.exceptions.ApiError("NOT_RECORDED", f"{method}: {os.path.basename(path)}")
+            if method == "places_photo":
+                return [base64.b64decode(response)]
+            return response
+
+        call.__name__ = method
+        return call
+
+# --- 공유 HTTP 세션 ---
+# 프로세스 전체가 keep-alive 연결 풀 하나를 같이 써서 rerun/세션마다 TLS 연결을 새로 맺지 않음
+HTTP_POOL_HOSTS = 4     # 호스트별 풀 수 (maps.googleapis.com 등)
+HTTP_POOL_MAXSIZE = 32  # 호스트당 유지할 연결 수 (동시 세션 × 구간 조회 스레드)
+
+@st.cache_resource
+def _http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def http_pool_stats():
+    """호스트별 {'connections': 새로 맺은 연결 수, 'requests': 보낸 요청 수}."""
+    stats = {}
+    for adapter in dict.fromkeys(_http_session().adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats[pool.host] = {
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+            }
+    return stats
+
+class SingleAttemptMapsClient(googlemaps.Client):
+    """HTTP 요청을 한 번만 보내는 클라이언트. 라이브러리는 5xx 응답을 retry_timeout 동안
+    스스로 다시 보내는데, 그러면 _maps_call의 재시도 안에서 또 재시도하게 되어 MAPS_DEADLINE_SEC를 넘음.
+    내부 재시도 차례가 오면 TransportError로 끝내서 재시도와 백오프는 _maps_call만 맡게 함."""
+
+    def _request(self, url, params, first_request_time=None, retry_counter=0, *args, **kwargs):
+        if retry_counter > 0:
+            raise googlemaps.exceptions.TransportError("retriable response (retried by _maps_call)")
+        return super()._request(url, params, first_request_time, retry_counter, *args, **kwargs)
+
+@st.cache_resource
+def _maps_client():
+    """프로세스당 한 번만 만드는 지도 클라이언트 (공유 HTTP 세션 사용)."""
+    if MAPS_MODE == "replay":
+        return ReplayMapsClient(MAPS_FIXTURE_DIR, st.secrets.get("MAPS_REPLAY_LATENCY_MS", 0))
+    # 요청 하나가 오래 붙잡지 않도록 응답 제한을 짧게, 재시도는 _maps_call에서만 함
+    client = SingleAttemptMapsClient(
+        key=st.secrets["GOOGLE_MAPS_API_KEY"],
+        timeout=MAPS_TIMEOUT_SEC,
+        retry_timeout=MAPS_TIMEOUT_SEC,
+        retry_over_query_limit=False,
+        requests_session=_http_session(),
+    )
+    if MAPS_MODE == "record":
+        return RecordingMapsClient(client, MAPS_FIXTURE_DIR)
+    return client
+
 try:
-    gmaps = googlemaps.Client(key=st.secrets["GOOGLE_MAPS_API_KEY"])
-    GMAPS_API_KEY = st.secrets["GOOGLE_MAPS_API_KEY"]
+    gmaps = _maps_client()
 except Exception:
     st.error("Google Maps API Key가 설정되지 않았습니다.")
     st.stop()
 
+# --- 로컬 키-값 캐시 (SQLite) ---
+# 지도 API 응답처럼 다시 받기 비싼 값을 프로세스/세션 재시작 후에도 재사용 (모든 세션 공유)
+# replay 모드는 실제 응답 캐시와 섞이지 않도록 별도 파일
+MAPS_CACHE_PATH = os.path.join(LOCAL_CACHE_DIR, "maps_cache_replay.db" if MAPS_MODE == "replay" else "maps_cache.db")
+
+class LocalKVCache:
+    """key → JSON 값. 만료(ttl초)된 항목은 기본적으로 무시하고, max_entries를 넘으면 가장 오래 안 쓴 항목부터 삭제."""
+
+    def __init__(self, path, table, ttl, max_entries):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_accessed ON {table}(accessed)")
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, stale_ok=False):
+        """저장된 값 (없거나 만료됐으면 None). stale_ok면 만료된 값도 반환 (API 장애 시 대체용).
+        만료된 항목은 바로 지우지 않고 크기 제한에 따라 밀려나게 둠."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None or (now - row[1] > self.ttl and not stale_ok):
+                if not stale_ok:
+                    self.misses += 1
+                return None
+            if not stale_ok:
+                self.hits += 1
+            self._conn.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False, default=str), now, now),
+            )
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN ("
+                f"SELECT key FROM {self.table} ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+# --- 지도 API 호출 제한 (토큰 버킷) + 재시도 + 회로 차단 ---
+MAPS_RATE_PER_SEC = 10.0  # API 할당량에 맞춘 초당 요청 수 (모든 세션 합산)
+MAPS_BURST = 10           # 순간적으로 허용하는 요청 수
+MAPS_MAX_WORKERS = 4      # 구간 동시 조회 스레드 수
+MAPS_RETRIES = 3          # 일시적 오류 재시도 횟수
+MAPS_RETRY_BASE_SEC = 0.5
+MAPS_BREAKER_FAILURES = 5         # 엔드포인트별로 연속 이만큼 실패하면 호출 차단
+MAPS_BREAKER_COOLDOWN_SEC = 30.0  # 차단 후 이 시간이 지나면 한 번 시험 호출
+
+class TokenBucket:
+    """초당 rate개씩 채워지는 토큰 버킷. acquire()는 토큰이 생길 때까지 기다림."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class MapsUnavailable(Exception):
+    """회로 차단 중이라 지도 API를 호출하지 않음 (호출하는 쪽은 캐시/축소된 결과로 대신)."""
+
+class CircuitBreaker:
+    """연속 실패가 threshold번이면 열림(호출 차단). cooldown 뒤에는 시험 호출 하나만 허용하고,
+    성공하면 닫히고 실패하면 다시 cooldown 동안 열림."""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def release(self):
+        """호출하지 못하고 끝난 시험 호출을 되돌림 (결과 없음 — 다음 호출이 다시 시험 호출이 될 수 있음)."""
+        with self._lock:
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+@st.cache_resource
+def _maps_rate_limiter():
+    return TokenBucket(MAPS_RATE_PER_SEC, MAPS_BURST)
+
+@st.cache_resource
+def _maps_breakers():
+    return {}  # 엔드포인트(함수 이름) -> CircuitBreaker
+
+def _maps_breaker(endpoint):
+    return _maps_breakers().setdefault(endpoint, CircuitBreaker(MAPS_BREAKER_FAILURES, MAPS_BREAKER_COOLDOWN_SEC))
+
+def maps_degraded():
+    """회로가 열려 있는(응답이 느리거나 실패 중인) 엔드포인트 목록."""
+    return [name for name, breaker in _maps_breakers().items() if breaker.is_open]
+
+# --- 지도 API 할당량 ---
+# 엔드포인트별 일일/분당 한도 (Distance Matrix는 요소 수 기준). secrets의 MAPS_DAILY_CAPS / MAPS_MINUTE_CAPS로 덮어씀
+MAPS_DAILY_CAPS = {
+    "places_autocomplete": 1000,
+    "place": 500,
+    "directions": 1000,
+    "distance_matrix": 10000,
+    "places_photo": 500,
+}
+MAPS_MINUTE_CAPS = {
+    "places_autocomplete": 60,
+    "place": 60,
+    "directions": 120,
+    "distance_matrix": 1000,
+    "places_photo": 60,
+}
+
+class MapsQuotaExceeded(MapsUnavailable):
+    """일일/분당 한도에 걸려 호출하지 않음."""
+
+class QuotaGovernor:
+    """엔드포인트별 사용량을 세고 한도를 넘는 호출을 막음. 일별 사용량은 디스크에 누적, 분당 사용량은 메모리."""
+
+    def __init__(self, path, daily_caps, minute_caps):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.daily_caps = daily_caps
+        self.minute_caps = minute_caps
+        self.blocked = {}  # endpoint -> 한도 때문에 막은 호출 수 (프로세스 시작 후)
+        self._recent = {}  # endpoint -> deque[(monotonic 시각, 사용량)]
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS quota_usage ("
+            "day TEXT NOT NULL, endpoint TEXT NOT NULL, units INTEGER NOT NULL, PRIMARY KEY (day, endpoint))"
+        )
+
+    def _minute_window(self, endpoint, now):
+        window = self._recent.setdefault(endpoint, deque())
+        while window and now - window[0][0] > 60:
+            window.popleft()
+        return window
+
+    def acquire(self, endpoint, units=1):
+        """한도 안이면 사용량을 기록하고, 넘으면 MapsQuotaExceeded."""
+        day = date_type.today().isoformat()
+        now = time.monotonic()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT units FROM quota_usage WHERE day = ? AND endpoint = ?", (day, endpoint)
+            ).fetchone()
+            used_today = row[0] if row else 0
+            window = self._minute_window(endpoint, now)
+            daily_cap = self.daily_caps.get(endpoint)
+            minute_cap = self.minute_caps.get(endpoint)
+            if daily_cap is not None and used_today + units > daily_cap:
+                self.blocked[endpoint] = self.blocked.get(endpoint, 0) + 1
+                raise MapsQuotaExceeded(f"{endpoint}: 일일 한도 {daily_cap}")
+            if minute_cap is not None and sum(u for _, u in window) + units > minute_cap:
+                self.blocked[endpoint] = self.blocked.get(endpoint, 0) + 1
+                raise MapsQuotaExceeded(f"{endpoint}: 분당 한도 {minute_cap}")
+            window.append((now, units))
+            self._conn.execute(
+                "INSERT INTO quota_usage (day, endpoint, units) VALUES (?, ?, ?) "
+                "ON CONFLICT(day, endpoint) DO UPDATE SET units = units + excluded.units",
+                (day, endpoint, units),
+            )
+
+    def usage(self):
+        """{endpoint: (오늘 사용량, 최근 1분 사용량)}"""
+        day = date_type.today().isoformat()
+        now = time.monotonic()
+        with self._lock:
+            today = dict(self._conn.execute(
+                "SELECT endpoint, units FROM quota_usage WHERE day = ?", (day,)
+            ).fetchall())
+            minute = {e: sum(u for _, u in self._minute_window(e, now)) for e in list(self._recent)}
+        return {e: (today.get(e, 0), minute.get(e, 0)) for e in set(today) | set(minute)}
+
+@st.cache_resource
+def _quota_governor():
+    if MAPS_MODE == "replay":
+        return QuotaGovernor(MAPS_CACHE_PATH, {}, {})  # 재생은 과금이 없으니 세기만
+    return QuotaGovernor(
+        MAPS_CACHE_PATH,
+        {**MAPS_DAILY_CAPS, **st.secrets.get("MAPS_DAILY_CAPS", {})},
+        {**MAPS_MINUTE_CAPS, **st.secrets.get("MAPS_MINUTE_CAPS", {})},
+    )
+
+def _request_units(endpoint, args):
+    """과금 단위. Distance Matrix는 출발지 × 도착지 요소 수, 나머지는 요청 1건."""
+    if endpoint == "distance_matrix":
+        return len(args[0]) * len(args[1])
+    return 1
+
+def _is_retriable(error):
+    if isinstance(error, (googlemaps.exceptions.Timeout, googlemaps.exceptions.TransportError)):
+        return True
+    return isinstance(error, googlemaps.exceptions.ApiError) and error.status in ("OVER_QUERY_LIMIT", "UNKNOWN_ERROR")
+
+def _maps_call(fn, *args, **kwargs):
+    """호출 제한을 지키며 fn 실행. 일시적 오류는 지수 백오프(+지터)로 MAPS_DEADLINE_SEC 안에서 재시도.
+    재시도해도 안 되면 해당 엔드포인트의 회로 차단기에 실패로 기록하고, 차단 중이면 MapsUnavailable.
+    할당량 한도에 걸리면 MapsQuotaExceeded (호출하는 쪽은 캐시된 결과로 대신)."""
+    endpoint = fn.__name__
+    breaker = _maps_breaker(endpoint)
+    if not breaker.allow():
+        raise MapsUnavailable(endpoint)
+    governor = _quota_governor()
+    limiter = _maps_rate_limiter()
+    deadline = time.monotonic() + MAPS_DEADLINE_SEC
+    for attempt in range(MAPS_RETRIES + 1):
+        try:
+            # 재시도도 과금되므로 시도마다 셈. 라이브러리 내부 재시도는 없으므로(SingleAttemptMapsClient) 시도 = HTTP 요청 하나
+            governor.acquire(endpoint, _request_units(endpoint, args))
+        except MapsQuotaExceeded:
+            breaker.release()  # API를 부르지 않았으므로 시험 호출이었다면 풀어 줌
+            raise
+        limiter.acquire()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if not _is_retriable(e):
+                breaker.success()  # 응답은 온 것 (요청 자체의 문제)
+                raise
+            delay = MAPS_RETRY_BASE_SEC * 2 ** attempt * (1 + random.random())
+            if attempt == MAPS_RETRIES or time.monotonic() + delay > deadline:
+                breaker.failure()
+                raise
+            time.sleep(delay)
+            continue
+        breaker.success()
+        return result
+
+# --- 길찾기(Directions) 캐시 ---
+# 키: (출발 좌표, 도착 좌표, 이동수단, 출발 시각(시 단위)) — 같은 구간은 세션/재시작과 관계없이 API 호출 없이 재사용
+DIRECTIONS_COORD_DIGITS = 4          # 좌표 반올림 자릿수 (약 11m)
+DIRECTIONS_TTL_SEC = 7 * 24 * 3600   # 도로/교통 패턴이 바뀔 수 있으니 일주일 뒤에는 다시 조회
+DIRECTIONS_MAX_ENTRIES = 5000
+DIRECTIONS_MAX_WAYPOINTS = 25        # 요청 한 번에 넣을 수 있는 중간 경유지 수 상한
+
+@st.cache_resource
+def _directions_cache():
+    return LocalKVCache(MAPS_CACHE_PATH, "directions", DIRECTIONS_TTL_SEC, DIRECTIONS_MAX_ENTRIES)
+
+def _pair_key(a, b, mode, hour):
+    """(위도, 경도) 두 점 + 이동수단 + 출발 시각(시) 캐시 키."""
+    digits = DIRECTIONS_COORD_DIGITS
+    return json.dumps([
+        round(a[0], digits), round(a[1], digits),
+        round(b[0], digits), round(b[1], digits),
+        mode, hour,
+    ])
+
+def _directions_key(a, b, mode, departure):
+    return _pair_key((a['lat'], a['lng']), (b['lat'], b['lng']), mode, departure.hour)
+
+def get_directions(a, b, mode="driving"):
+    """두 장소 간 경로 요약 {'duration', 'distance', 'polyline'} (경로가 없으면 None).
+    좌표로 못 찾으면 주소로 다시 조회. 결과는 공유 디스크 캐시에 보관."""
+    departure = datetime.now()
+    key = _directions_key(a, b, mode, departure)
+    cache = _directions_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    try:
+        route = _request_directions(a, b, mode, departure)
+    except Exception:
+        # API가 느리거나 차단 중이면 만료된 캐시라도 사용
+        stale = cache.get(key, stale_ok=True)
+        if stale is not None:
+            return stale
+        raise
+    if route is not None:
+        cache.set(key, route)
+    return route
+
+def _request_directions(a, b, mode, departure):
+    """좌표로 경로 요청, 못 찾으면 주소로 다시 요청. 경로가 없으면 None."""
+    dirs = _maps_call(
+        gmaps.directions,
+        (a['lat'], a['lng']),
+        (b['lat'], b['lng']),
+        mode=mode,
+        language="ko",
+        departure_time=departure,
+    )
+    if not dirs:
+        dirs = _maps_call(
+            gmaps.directions,
+            a['address'], b['address'],
+            mode=mode,
+            language="ko",
+            departure_time=departure,
+        )
+    if not dirs:
+        return None
+    return _leg_summary(dirs[0]['legs'][0], dirs[0]['overview_polyline']['points'])
+
+def _leg_summary(leg, overview=None):
+    """Directions 응답의 leg 하나 → {'duration', 'distance', 'polyline'}.
+    경유지가 있는 응답은 overview가 전체 경로라서, 구간 polyline은 step polyline을 이어 붙여 만듦."""
+    if overview is None:
+        coords = []
+        for step in leg['steps']:
+            points = polyline_decoder.decode(step['polyline']['points'])
+            coords.extend(points[1:] if coords and points and coords[-1] == points[0] else points)
+        overview = polyline_decoder.encode(coords)
+    return {
+        # duration_in_traffic: 실시간 교통 반영 (경유지가 있는 요청에는 없음) / 없으면 기본값 사용
+        'duration': leg.get('duration_in_traffic', leg['duration'])['text'],
+        'distance': leg['distance']['text'],
+        'polyline': overview,
+    }
+
+def _directions_chunk(points, mode, departure):
+    """points[0] → points[-1] (사이는 경유지) 요청 한 번으로 구간별 요약 목록. 경로가 없으면 None."""
+    dirs = _maps_call(
+        gmaps.directions,
+        (points[0]['lat'], points[0]['lng']),
+        (points[-1]['lat'], points[-1]['lng']),
+        waypoints=[(p['lat'], p['lng']) for p in points[1:-1]],
+        mode=mode,
+        language="ko",
+        departure_time=departure,
+    )
+    if not dirs or len(dirs[0]['legs']) != len(points) - 1:
+        return None
+    return [_leg_summary(leg) for leg in dirs[0]['legs']]
+
+def _directions_or_none(a, b, mode):
+    try:
+        return get_directions(a, b, mode)
+    except Exception:
+        return None
+
+def get_route_legs(places, indices=None, mode="driving"):
+    """places를 순서대로 지나는 경로의 구간 i (places[i] → places[i+1]) 요약을 {i: 요약 또는 None}으로 반환.
+    캐시에 없는 연속 구간은 경유지를 넣은 요청 한 번으로 받고, 경유지 상한을 넘으면 나눠서 동시에 요청."""
+    if indices is None:
+        indices = range(len(places) - 1)
+    departure = datetime.now()
+    cache = _directions_cache()
+    result, chunks = {}, []
+    for i in indices:
+        hit = cache.get(_directions_key(places[i], places[i + 1], mode, departure))
+        if hit is not None:
+            result[i] = hit
+        elif chunks and chunks[-1][-1] == i - 1 and len(chunks[-1]) <= DIRECTIONS_MAX_WAYPOINTS:
+            chunks[-1].append(i)
+        else:
+            chunks.append([i])
+
+    def _fetch(chunk):
+        points = places[chunk[0]:chunk[-1] + 2]
+        legs = None
+        if len(chunk) > 1:
+            try:
+                legs = _directions_chunk(points, mode, departure)
+            except Exception:
+                legs = None
+        if legs is None:
+            # 한 구간짜리이거나 경유지 요청이 실패하면 구간별로 (주소 재조회 포함)
+            return [_directions_or_none(a, b, mode) for a, b in zip(points, points[1:])]
+        for a, b, leg in zip(points, points[1:], legs):
+            cache.set(_directions_key(a, b, mode, departure), leg)
+        return legs
+
+    if chunks:
+        with ThreadPoolExecutor(max_workers=min(MAPS_MAX_WORKERS, len(chunks))) as pool:
+            for chunk, legs in zip(chunks, pool.map(_fetch, chunks)):
+                result.update(zip(chunk, legs))
+    return result
+
+# --- 이동 시간/거리 행렬 (Distance Matrix) ---
+# 모든 장소 쌍의 소요시간(초)/거리(m)를 NumPy 행렬로. 경로 모양(polyline)이 필요 없는 기능은 이것만 사용.
+MATRIX_BLOCK = 10  # 요청당 출발 10곳 × 도착 10곳 = 100개 요소 (API 상한)
+
+@st.cache_resource
+def _matrix_cache():
+    return LocalKVCache(MAPS_CACHE_PATH, "matrix", DIRECTIONS_TTL_SEC, DIRECTIONS_MAX_ENTRIES * 4)
+
+class TravelMatrix:
+    """장소 간 이동 행렬. 행 = 출발, 열 = 도착 (장소 순서). 경로가 없거나 조회 실패면 NaN."""
+
+    def __init__(self, points, durations, distances):
+        self.points = points        # ((lat, lng), ...)
+        self.durations = durations  # 초
+        self.distances = distances  # 미터
+
+def _fetch_matrix_block(origins, destinations, mode, departure):
+    return _maps_call(
+        gmaps.distance_matrix,
+        list(origins), list(destinations),
+        mode=mode,
+        language="ko",
+        departure_time=departure,
+    )
+
+def _matrix_blocks(missing, n):
+    """캐시에 없는 (출발, 도착) 쌍을 덮는 (출발 목록, 도착 목록) 블록. 실제로 빠진 쌍만 요청하도록
+    - 대부분 빠진 출발지(새 장소) → 모든 도착지
+    - 나머지 출발지 중 새 장소로 가는 쌍 → 새 장소 열만
+    - 그 밖에 드문드문 빠진 쌍(만료/실패) → 빠진 열이 같은 출발지끼리 묶음"""
+    by_row = {}
+    for i, j in missing:
+        by_row.setdefault(i, set()).add(j)
+    new = sorted(i for i, cols in by_row.items() if len(cols) * 2 >= n - 1)
+    new_set = set(new)
+    groups = {}
+    if new:
+        groups[tuple(range(n))] = new
+    for i in sorted(set(by_row) - new_set):
+        cols = by_row[i]
+        if cols & new_set:
+            groups.setdefault(tuple(new), []).append(i)
+        if cols - new_set:
+            groups.setdefault(tuple(sorted(cols - new_set)), []).append(i)
+    return [
+        (rows[r:r + MATRIX_BLOCK], list(cols[c:c + MATRIX_BLOCK]))
+        for cols, rows in groups.items()
+        for r in range(0, len(rows), MATRIX_BLOCK)
+        for c in range(0, len(cols), MATRIX_BLOCK)
+    ]
+
+def travel_matrix(places, mode="driving"):
+    """places 전체 쌍의 TravelMatrix. 요소별 결과는 공유 디스크 캐시에, 행렬은 세션에 보관하고
+    캐시에 없는 요소만 10×10 블록 Distance Matrix 요청으로 (동시에) 채움."""
+    departure = datetime.now()
+    points = tuple((p['lat'], p['lng']) for p in places)
+    memo_key = (points, mode, departure.hour)
+    memo = st.session_state.get('travel_matrix')
+    if memo and memo[0] == memo_key:
+        return memo[1]
+
+    n = len(points)
+    durations = np.full((n, n), np.nan)
+    distances = np.full((n, n), np.nan)
+    np.fill_diagonal(durations, 0)
+    np.fill_diagonal(distances, 0)
+    cache = _matrix_cache()
+    missing = []
+    for i in range(n):
+        for j in range(n):
+            if i == j:
+                continue
+            hit = cache.get(_pair_key(points[i], points[j], mode, departure.hour))
+            if hit is None:
+                missing.append((i, j))
+            elif hit[0] is not None:
+                durations[i, j], distances[i, j] = hit
+
+    blocks = _matrix_blocks(missing, n)
+
+    def _fetch(block):
+        try:
+            return _fetch_matrix_block([points[i] for i in block[0]], [points[j] for j in block[1]], mode, departure)
+        except Exception:
+            return None
+
+    complete = True
+    if blocks:
+        with ThreadPoolExecutor(max_workers=min(MAPS_MAX_WORKERS, len(blocks))) as pool:
+            for (row_ids, col_ids), resp in zip(blocks, pool.map(_fetch, blocks)):
+                if resp is None:
+                    complete = False
+                    continue
+                for i, row in zip(row_ids, resp['rows']):
+                    for j, el in zip(col_ids, row['elements']):
+                        if i == j:
+                            continue
+                        value = [None, None]
+                        if el.get('status') == 'OK':
+                            value = [el.get('duration_in_traffic', el['duration'])['value'], el['distance']['value']]
+                            durations[i, j], distances[i, j] = value
+                        cache.set(_pair_key(points[i], points[j], mode, departure.hour), value)
+
+    matrix = TravelMatrix(points, durations, distances)
+    if complete:
+        # 요청이 실패한 요소가 있으면 다음 실행 때 다시 시도하도록 보관하지 않음
+        st.session_state['travel_matrix'] = (memo_key, matrix)
+    return matrix
+
+def _format_duration(seconds):
+    minutes = int(round(seconds / 60))
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}시간 {minutes}분" if minutes else f"{hours}시간"
+    return f"{minutes}분"
+
+def _format_distance(meters):
+    return f"{meters / 1000:.1f}km"
+
+# --- 방문 순서 최적화 ---
+# 이동 행렬로 최근접 이웃 경로를 만든 뒤 2-opt / Or-opt로 개선 (출발지, 도착지는 고정)
+ROUTE_OPT_MAX_PASSES = 50
+ROUTE_UNREACHABLE_PENALTY = 10.0  # 경로가 없는 구간은 가장 긴 구간의 이 배수로 취급
+
+def _path_cost(cost, order):
+    return sum(cost[a][b] for a, b in zip(order, order[1:]))
+
+def _two_opt(cost, order):
+    """구간 뒤집기로 개선. 비대칭 행렬이라 뒤집힌 구간의 역방향 비용을 누적합으로 계산."""
+    def _prefix_sums():
+        fwd, bwd = [0.0], [0.0]
+        for a, b in zip(order, order[1:]):
+            fwd.append(fwd[-1] + cost[a][b])
+            bwd.append(bwd[-1] + cost[b][a])
+        return fwd, bwd
+
+    n = len(order)
+    improved = True
+    passes = 0
+    while improved and passes < ROUTE_OPT_MAX_PASSES:
+        improved = False
+        passes += 1
+        fwd, bwd = _prefix_sums()
+        for i in range(1, n - 2):
+            for j in range(i + 1, n - 1):
+                p, a, b, q = order[i - 1], order[i], order[j], order[j + 1]
+                before = cost[p][a] + (fwd[j] - fwd[i]) + cost[b][q]
+                after = cost[p][b] + (bwd[j] - bwd[i]) + cost[a][q]
+                if after < before - 1e-9:
+                    order[i:j + 1] = order[i:j + 1][::-1]
+                    fwd, bwd = _prefix_sums()
+                    improved = True
+    return order
+
+def _or_opt(cost, order):
+    """길이 1~3인 구간을 방향 그대로 다른 위치로 옮겨서 개선."""
+    improved = True
+    passes = 0
+    while improved and passes < ROUTE_OPT_MAX_PASSES:
+        improved = False
+        passes += 1
+        n = len(order)
+        for length in (1, 2, 3):
+            for i in range(1, n - length):
+                seg = order[i:i + length]
+                p, q = order[i - 1], order[i + length]
+                removed = cost[p][seg[0]] + cost[seg[-1]][q] - cost[p][q]
+                rest = order[:i] + order[i + length:]
+                best, best_at = removed - 1e-9, None
+                for k in range(len(rest) - 1):
+                    if k == i - 1:
+                        continue
+                    added = cost[rest[k]][seg[0]] + cost[seg[-1]][rest[k + 1]] - cost[rest[k]][rest[k + 1]]
+                    if added < best:
+                        best, best_at = added, k
+                if best_at is not None:
+                    order[:] = rest[:best_at + 1] + seg + rest[best_at + 1:]
+                    improved = True
+    return order
+
+def optimize_route(durations, start=0, end=None):
+    """이동 시간 행렬(NaN = 경로 없음)로 start에서 출발해 end(None이면 아무 데서나 끝남)로 끝나는 방문 순서 반환."""
+    n = len(durations)
+    if n < 3:
+        return list(range(n))
+    finite = durations[np.isfinite(durations)]
+    cost = np.where(np.isfinite(durations), durations, (finite.max() if finite.size else 1.0) * ROUTE_UNREACHABLE_PENALTY)
+    if end is None:
+        # 도착지가 자유면 모든 곳에서 비용 0으로 갈 수 있는 가상 도착지를 둠
+        cost = np.pad(cost, ((0, 1), (0, 1)))
+        last = n
+    else:
+        last = end
+    cost = cost.tolist()
+
+    # 최근접 이웃으로 초기 경로
+    remaining = set(range(n)) - {start, last}
+    order = [start]
+    while remaining:
+        nxt = min(remaining, key=lambda j: cost[order[-1]][j])
+        order.append(nxt)
+        remaining.remove(nxt)
+    order.append(last)
+
+    # 두 개선을 번갈아 더 이상 줄지 않을 때까지
+    best = _path_cost(cost, order)
+    for _ in range(ROUTE_OPT_MAX_PASSES):
+        order = _or_opt(cost, _two_opt(cost, order))
+        total = _path_cost(cost, order)
+        if total >= best - 1e-9:
+            break
+        best = total
+    return order if end is not None else order[:-1]
+
+def route_duration(durations, order):
+    """order 순서대로 지날 때의 총 이동 시간(초). 경로가 없는 구간이 있으면 NaN."""
+    return float(sum(durations[a, b] for a, b in zip(order, order[1:])))
+
+# --- 장소 검색 자동완성 캐시 ---
+# 같은 검색어(정규화 기준)는 모든 세션이 프로세스 메모리 캐시를 공유.
+# 자동완성과 이어지는 상세 조회는 Places 세션 토큰으로 묶어서 한 세션으로 과금되게 함.
+AUTOCOMPLETE_TTL_SEC = 24 * 3600
+AUTOCOMPLETE_MAX_ENTRIES = 500
+
+class LRUCache:
+    """프로세스 메모리 LRU + TTL 캐시 (스레드 안전)."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (저장 시각, 값)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+@st.cache_resource
+def _autocomplete_cache():
+    return LRUCache(AUTOCOMPLETE_MAX_ENTRIES, AUTOCOMPLETE_TTL_SEC)
+
+def _normalize_query(query):
+    return " ".join(query.casefold().split())
+
+def places_session_token():
+    """현재 검색 세션 토큰 (없으면 새로 발급). 상세 조회에서 pop 해서 세션을 끝냄."""
+    if not st.session_state.get('places_session_token'):
+        st.session_state['places_session_token'] = uuid.uuid4().hex
+    return st.session_state['places_session_token']
+
+def search_places(query, language="ko", country="us"):
+    """자동완성 후보 목록. (정규화한 검색어, 언어, 국가)별로 캐싱."""
+    key = (_normalize_query(query), language, country)
+    cache = _autocomplete_cache()
+    results = cache.get(key)
+    if results is None:
+        results = _maps_call(
+            gmaps.places_autocomplete,
+            query,
+            session_token=places_session_token(),
+            language=language,
+            components={"country": country},
+        )
+        cache.set(key, results)
+    return copy.deepcopy(results)
+
+# --- 장소 상세 정보 캐시 ---
+# (place_id, 요청 필드, 언어)별로 디스크에 보관. 전체 필드 요청이 안 되는 place_id는 기억해서 다음부터 바로 기본 필드로.
+PLACE_FIELDS_FULL = ['name', 'geometry', 'formatted_address', 'rating',
+                     'user_ratings_total', 'opening_hours', 'website',
+                     'international_phone_number', 'photos']
+PLACE_FIELDS_BASIC = ['name', 'geometry', 'formatted_address']
+PLACE_DETAILS_TTL_SEC = 7 * 24 * 3600  # 영업시간/평점이 바뀔 수 있으니 일주일 뒤 다시 조회
+PLACE_DETAILS_MAX_ENTRIES = 2000
+
+@st.cache_resource
+def _place_details_cache():
+    return LocalKVCache(MAPS_CACHE_PATH, "place_details", PLACE_DETAILS_TTL_SEC, PLACE_DETAILS_MAX_ENTRIES)
+
+def get_place_details(place_id, session_token=None, language="ko"):
+    """place_id의 상세 정보(result dict). 전체 필드 요청이 ValueError면 기본 필드만 다시 요청 (API 등급/billing 제한 대응).
+    기본 필드로도 안 되면 ValueError."""
+    cache = _place_details_cache()
+    basic_only_key = json.dumps(["basic_only", place_id])
+    attempts = [PLACE_FIELDS_BASIC] if cache.get(basic_only_key) else [PLACE_FIELDS_FULL, PLACE_FIELDS_BASIC]
+    for fields in attempts:
+        key = json.dumps([place_id, sorted(fields), language])
+        result = cache.get(key)
+        if result is not None:
+            return result
+        try:
+            result = _maps_call(
+                gmaps.place,
+                place_id,
+                session_token=session_token,
+                fields=fields,
+                language=language,
+            ).get('result', {})
+        except ValueError:
+            if fields is PLACE_FIELDS_BASIC:
+                raise
+            cache.set(basic_only_key, True)
+            continue
+        except Exception:
+            # API가 느리거나 차단 중이면 만료된 캐시라도 사용
+            stale = cache.get(key, stale_ok=True)
+            if stale is not None:
+                return stale
+            raise
+        cache.set(key, result)
+        return result
+
 # --- 애니메이션 GIF 로더 (st.image는 GIF 정지됨 → base64 HTML 필요) ---
 def load_gif_html(path, width=90):
     try:
@@ -184,66 +2184,363 @@ def load_gif_html(path, width=90):
     except Exception:
         return ""
 
-# --- 사진 URL 생성 ---
-def get_photo_url(photo_reference, max_width=400):
-    return (
-        f"https://maps.googleapis.com/maps/api/place/photo"
-        f"?maxwidth={max_width}&photo_reference={photo_reference}&key={GMAPS_API_KEY}"
-    )
+# --- 장소 사진 캐시 ---
+# photo_reference별로 Photo API를 한 번만 호출해서 팝업/썸네일 크기 JPEG로 디스크에 보관하고,
+# 지도에는 data URI로 넣음 (브라우저가 API 키가 든 URL을 직접 부르지 않음)
+PHOTO_CACHE_DIR = os.path.join(LOCAL_CACHE_DIR, "photos")
+PHOTO_SIZES = {"popup": 320, "thumb": 120}  # 크기 이름 → 최대 가로 픽셀
+PHOTO_CACHE_MAX_BYTES = 64 * 1024 * 1024
+PHOTO_RETRY_SEC = 600  # 내려받기 실패한 사진은 이 시간 동안 다시 시도하지 않음
+
+_PHOTO_REF_RE = re.compile(r"photo_reference=([^&]+)")
+
+def photo_ref_of(place):
+    """장소의 사진 참조값. 예전 데이터는 photo_url(Photo API URL)에서 추출."""
+    if place.get('photo_ref'):
+        return place['photo_ref']
+    match = _PHOTO_REF_RE.search(place.get('photo_url') or '')
+    return match.group(1) if match else None
+
+class PhotoCache:
+    """사진 파일 캐시. 전체 크기가 max_bytes를 넘으면 가장 오래 안 쓴 파일부터 삭제."""
+
+    def __init__(self, directory, max_bytes):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._uris = LRUCache(512, 24 * 3600)  # (ref, size) -> data URI
+        self._failed = LRUCache(512, PHOTO_RETRY_SEC)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _file(self, ref, size):
+        return os.path.join(self.directory, f"{hashlib.sha1(ref.encode()).hexdigest()[:24]}_{size}.jpg")
+
+    def path(self, ref, size="popup"):
+        """로컬 JPEG 경로 (없으면 내려받아 만듦). 실패하면 None."""
+        path = self._file(ref, size)
+        if os.path.exists(path):
+            os.utime(path)  # 최근 사용 시각 (삭제 순서 기준)
+            self.hits += 1
+            return path
+        self.misses += 1
+        if self._failed.get(ref):
+            return None
+        try:
+            self._download(ref)
+        except Exception:
+            self._failed.set(ref, True)
+            return None
+        return path
+
+    def data_uri(self, ref, size="popup"):
+        uri = self._uris.get((ref, size))
+        if uri is None:
+            path = self.path(ref, size)
+            if path is None:
+                return None
+            with open(path, "rb") as f:
+                uri = "data:image/jpeg;base64," + base64.b64encode(f.read()).decode("ascii")
+            self._uris.set((ref, size), uri)
+        return uri
+
+    def _download(self, ref):
+        # 가장 큰 크기로 한 번만 받고, 나머지 크기는 로컬에서 축소
+        chunks = _maps_call(gmaps.places_photo, ref, max_width=max(PHOTO_SIZES.values()))
+        image = Image.open(io.BytesIO(b"".join(chunks))).convert("RGB")
+        for size, width in PHOTO_SIZES.items():
+            resized = image.copy()
+            resized.thumbnail((width, width * 4))
+            tmp = self._file(ref, size) + ".tmp"
+            resized.save(tmp, "JPEG", quality=80, optimize=True)
+            os.replace(tmp, self._file(ref, size))
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            files = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+
+@st.cache_resource
+def _photo_cache():
+    return PhotoCache(PHOTO_CACHE_DIR, PHOTO_CACHE_MAX_BYTES)
+
+def photo_data_uri(place, size="popup"):
+    """장소 대표 사진의 data URI (사진이 없거나 못 받으면 None)."""
+    ref = photo_ref_of(place)
+    return _photo_cache().data_uri(ref, size) if ref else None
+
+def photo_data_uris(places, size="popup"):
+    """장소 목록의 사진 data URI 목록. 캐시에 없는 사진은 한 장씩 기다리지 않고 동시에 내려받음."""
+    cache = _photo_cache()
+    refs = [photo_ref_of(p) for p in places]
+    unique = [r for r in dict.fromkeys(refs) if r]
+    uris = {}
+    if unique:
+        with ThreadPoolExecutor(max_workers=min(MAPS_MAX_WORKERS, len(unique))) as pool:
+            uris = dict(zip(unique, pool.map(lambda ref: cache.data_uri(ref, size), unique)))
+    return [uris.get(r) for r in refs]
 
 # --- 연속 지점 간 이동 시간 계산 ---
-def get_segment_times(places):
-    """각 연속 지점 쌍의 이동 시간을 계산하여 반환 (캐싱)"""
+def _segment_key(a, b):
+    return (a['name'], a['lat'], a['lng'], b['name'], b['lat'], b['lng'])
+
+def _segment_legs(places):
+    """연속 구간별 경로 요약 {i: {'duration', 'distance', 'polyline'} 또는 None}.
+    구간(순서 있는 장소 쌍)별로 캐싱해서, 장소 추가/삭제/순서 변경 시 새로 생긴 구간만 조회."""
+    pairs = list(zip(places, places[1:]))
+    keys = [_segment_key(a, b) for a, b in pairs]
+    cached = st.session_state.get('segment_times_cache', {})
+    missing = [i for i, k in enumerate(keys) if k not in cached]
+    if missing:
+        # 새 구간만, 연속 구간은 경유지 요청 한 번으로
+        legs = get_route_legs(places, missing)
+        for i in missing:
+            cached[keys[i]] = legs.get(i)
+    # 지금 경로에 없는 구간은 버림
+    st.session_state['segment_times_cache'] = {k: cached[k] for k in keys}
+    return {i: cached[k] for i, k in enumerate(keys)}
+
+def get_segment_times(places, with_geometry=True):
+    """각 연속 지점 쌍의 이동 정보 목록 (못 찾은 구간은 None).
+    with_geometry면 지도에 그릴 경로를 받는 Directions 구간 요약의 소요시간/거리를 그대로 쓰고,
+    아니면 이동 행렬에서 가져옴 (polyline은 None) — 같은 구간을 두 API로 중복 과금하지 않음."""
     if len(places) < 2:
         return []
 
-    # 캐시 키: 장소 이름 목록
-    cache_key = "_".join(p['name'] for p in places)
-    cached = st.session_state.get('segment_times_cache', {})
-    if cached.get('key') == cache_key:
-        return cached.get('times', [])
-
+    if with_geometry:
+        legs = _segment_legs(places)
+    else:
+        matrix = travel_matrix(places)
+        legs = {
+            i: {
+                'duration': _format_duration(matrix.durations[i, i + 1]),
+                'distance': _format_distance(matrix.distances[i, i + 1]),
+                'polyline': None,
+            }
+            for i in range(len(places) - 1)
+            if not np.isnan(matrix.durations[i, i + 1])
+        }
     times = []
-    for i in range(len(places) - 1):
-        a = places[i]
-        b = places[i + 1]
-        try:
-            _now = datetime.utcnow()
-            dirs = gmaps.directions(
-                (a['lat'], a['lng']),
-                (b['lat'], b['lng']),
-                mode="driving",
-                language="ko",
-                departure_time=_now,
-            )
-            if not dirs:
-                dirs = gmaps.directions(
-                    a['address'], b['address'],
-                    mode="driving",
-                    language="ko",
-                    departure_time=_now,
-                )
-            if dirs:
-                leg = dirs[0]['legs'][0]
-                # duration_in_traffic: 실시간 교통 반영 / 없으면 기본값 사용
-                duration_text = leg.get('duration_in_traffic', leg['duration'])['text']
-                times.append({
-                    'from': a['name'],
-                    'to': b['name'],
-                    'duration': duration_text,
-                    'distance': leg['distance']['text'],
-                    'polyline': dirs[0]['overview_polyline']['points'],
-                    'mid_lat': (a['lat'] + b['lat']) / 2,
-                    'mid_lng': (a['lng'] + b['lng']) / 2,
-                })
-            else:
-                times.append(None)
-        except Exception:
+    for i, (a, b) in enumerate(zip(places, places[1:])):
+        leg = legs.get(i)
+        if leg is None:
             times.append(None)
-
-    st.session_state['segment_times_cache'] = {'key': cache_key, 'times': times}
+            continue
+        times.append({
+            'from': a['name'],
+            'to': b['name'],
+            'duration': leg['duration'],
+            'distance': leg['distance'],
+            'polyline': leg['polyline'],
+            'mid_lat': (a['lat'] + b['lat']) / 2,
+            'mid_lng': (a['lng'] + b['lng']) / 2,
+        })
     return times
 
+# --- 메인 지도 HTML ---
+# 지도 마커 공통 스타일 (지도 문서 <head>에 한 번만 들어감). 마커별 색은 --c 변수로 받음
+MAP_MARKER_CSS = """
+.tm-pin,.tm-seg,.tm-popup{font-family:'Noto Sans KR',sans-serif}
+.tm-pin{width:90px;text-align:center;position:relative}
+.tm-photo{width:60px;height:60px;margin:0 auto;border-radius:50%;border:3px solid var(--c);
+  background:var(--c) center/cover no-repeat;box-shadow:0 3px 10px rgba(0,0,0,.4)}
+.tm-badge{position:absolute;top:-6px;left:58px;width:22px;height:22px;line-height:22px;
+  border-radius:50%;background:var(--c);color:#fff;font-size:11px;font-weight:bold;
+  border:2px solid #fff;box-shadow:0 1px 4px rgba(0,0,0,.3)}
+.tm-num{width:44px;height:44px;line-height:44px;margin:0 auto;border-radius:50%;
+  background:var(--c);color:#fff;font-size:18px;font-weight:bold;
+  border:3px solid #fff;box-shadow:0 3px 10px rgba(0,0,0,.4)}
+.tm-name{display:inline-block;max-width:86px;margin-top:3px;padding:2px 6px;border-radius:8px;
+  background:var(--c);color:#fff;font-size:10px;font-weight:bold;white-space:nowrap;
+  overflow:hidden;text-overflow:ellipsis;box-shadow:0 1px 4px rgba(0,0,0,.2)}
+.tm-tail{width:0;height:0;margin:0 auto;border-left:8px solid transparent;
+  border-right:8px solid transparent;border-top:10px solid var(--c)}
+.tm-preview{width:160px}
+.tm-preview .tm-name{max-width:none;padding:6px 10px;border-radius:10px;font-size:11px;
+  border:2px solid #fff;box-shadow:0 3px 8px rgba(0,0,0,.3)}
+.tm-preview small{display:block;font-size:9px;opacity:.9}
+.tm-seg{display:inline-block;padding:4px 8px;border-radius:12px;background:var(--c);color:#fff;
+  font-size:12px;font-weight:bold;white-space:nowrap;border:2px solid #fff;
+  box-shadow:0 2px 6px rgba(0,0,0,.3)}
+.tm-popup{min-width:150px}
+.tm-popup .tm-img{height:110px;margin-bottom:8px;border-radius:8px;background:#eee center/cover no-repeat}
+.tm-popup b{display:block;font-size:14px;color:var(--c)}
+.tm-popup p{font-size:11px;color:#666;margin:4px 0 0}
+"""
+
+def _photo_css(photos):
+    """{CSS 클래스: 사진 data URI} → 배경 이미지 규칙. 사진은 문서에 한 번만 들어가고 마커와 팝업이 클래스로 같이 씀."""
+    return "".join(f".{cls}{{background-image:url({uri})}}" for cls, uri in photos.items())
+
+def _truncate(text, limit):
+    return text[:limit] + ('...' if len(text) > limit else '')
+
+def _place_marker_html(number, name, color, photo=None):
+    """장소 마커 (사진 클래스가 있으면 원형 사진 + 번호 배지, 없으면 번호 원). 스타일은 MAP_MARKER_CSS."""
+    if photo:
+        head = f'<div class="tm-photo {photo}"></div><div class="tm-badge">{number}</div>'
+    else:
+        head = f'<div class="tm-num">{number}</div>'
+    return (
+        f'<div class="tm-pin" style="--c:{color}">{head}'
+        f'<div class="tm-name">{_truncate(name, 10)}</div><div class="tm-tail"></div></div>'
+    )
+
+def _marker_popup_html(name, address, color, photo=None):
+    image = f'<div class="tm-img {photo}"></div>' if photo else ''
+    return f'<div class="tm-popup" style="--c:{color}">{image}<b>📍 {name}</b><p>{address}</p></div>'
+
+def build_map_html(places, segment_times, route, preview, center, zoom):
+    """tab2 메인 지도(구간 경로, 경로 계산 결과, 장소/미리보기 마커)를 그려서 HTML 문서로 직렬화."""
+    m = folium.Map(
+        location=center,
+        zoom_start=zoom,
+        tiles="http://mt0.google.com/vt/lyrs=m&hl=ko&x={x}&y={y}&z={z}",
+        attr="Google",
+        name="Google Maps"
+    )
+    # 마커 스타일은 공유 CSS 클래스로 한 번만 넣고, 마커마다 색/번호/이름/사진 클래스만 내보냄.
+    # 사진은 장소마다 작은 썸네일 하나를 마커와 팝업이 같이 씀 (캐시에 없는 사진은 동시에 받음)
+    thumbs = photo_data_uris(places, "thumb")
+    photos = {f"tm-ph{i}": uri for i, uri in enumerate(thumbs) if uri}
+    preview_photo = photo_data_uri(preview) if preview else None
+    if preview_photo:
+        photos["tm-ph-pv"] = preview_photo
+    m.get_root().header.add_child(folium.Element(f"<style>{MAP_MARKER_CSS}{_photo_css(photos)}</style>"))
+
+    # 팔레트: 지점 번호별 색상
+    COLORS = ["#FF6B6B", "#FF9F43", "#F7B731", "#26de81", "#45aaf2",
+              "#a55eea", "#fd9644", "#2bcbba", "#fc5c65", "#4b7bec"]
+
+    coordinates = []
+
+    # --- 세그먼트 폴리라인 & 시간 라벨 ---
+    if segment_times:
+        for i, seg in enumerate(segment_times):
+            if seg is None:
+                continue
+            a = places[i]
+            b = places[i + 1]
+            seg_color = COLORS[i % len(COLORS)]
+
+            # 세그먼트 경로 그리기 (경로를 조회하지 않았으면 직선)
+            decoded = polyline_decoder.decode(seg['polyline']) if seg['polyline'] else []
+            full_seg = [[a['lat'], a['lng']]] + decoded + [[b['lat'], b['lng']]]
+            folium.PolyLine(
+                locations=full_seg,
+                color=seg_color,
+                weight=5,
+                opacity=0.85,
+                tooltip=f"🚗 {seg['duration']} ({seg['distance']})"
+            ).add_to(m)
+
+            # 중간 지점에 이동시간 라벨 표시
+            mid_lat = seg['mid_lat']
+            mid_lng = seg['mid_lng']
+            label_html = f'<div class="tm-seg" style="--c:{seg_color}">🚗 {seg["duration"]}</div>'
+            folium.Marker(
+                location=[mid_lat, mid_lng],
+                icon=folium.DivIcon(
+                    html=label_html,
+                    icon_size=(120, 30),
+                    icon_anchor=(60, 15),
+                )
+            ).add_to(m)
+
+    # --- 단순 연결선 (세그먼트 없을 때, 경로 계산 결과 있을 때 제외) ---
+    for place in places:
+        coordinates.append([place['lat'], place['lng']])
+
+    if not segment_times and not route:
+        if len(coordinates) >= 2:
+            folium.PolyLine(
+                locations=coordinates,
+                color="#74b9ff",
+                weight=3,
+                opacity=0.6,
+                dash_array="8"
+            ).add_to(m)
+
+    # 경로 계산 결과 폴리라인 (특정 구간 경로)
+    if route and route[1] and route[2]:
+        route_polyline, rs, re_place = route
+        decoded = polyline_decoder.decode(route_polyline)
+        full_route = [[rs['lat'], rs['lng']]] + decoded + [[re_place['lat'], re_place['lng']]]
+        folium.PolyLine(
+            locations=full_route,
+            color="#0652DD",
+            weight=5,
+            opacity=0.9,
+            tooltip="최적 경로"
+        ).add_to(m)
+
+    # --- 커스텀 마커 (사진 + 번호 배지) ---
+    for i, place in enumerate(places):
+        color = COLORS[i % len(COLORS)]
+        photo = f"tm-ph{i}" if thumbs[i] else None
+        name = place['name']
+        folium.Marker(
+            location=[place['lat'], place['lng']],
+            popup=folium.Popup(_marker_popup_html(name, place.get('address', ''), color, photo), max_width=220),
+            tooltip=f"{i+1}. {name}",
+            icon=folium.DivIcon(
+                html=_place_marker_html(i + 1, name, color, photo),
+                icon_size=(90, 100),
+                icon_anchor=(45, 80),
+            )
+        ).add_to(m)
+
+    # --- 미리보기 마커 (초록색 핀) ---
+    if preview:
+        preview_html = (
+            f'<div class="tm-pin tm-preview" style="--c:#00b894">'
+            f'<div class="tm-name">📍 {_truncate(preview["name"], 15)}<small>미리보기</small></div>'
+            f'<div class="tm-tail"></div></div>'
+        )
+        folium.Marker(
+            location=[preview['lat'], preview['lng']],
+            popup=folium.Popup(
+                _marker_popup_html(preview['name'], preview.get('address', ''), "#00b894", "tm-ph-pv" if preview_photo else None),
+                max_width=220,
+            ),
+            tooltip=f"📍 {preview['name']} (미리보기)",
+            icon=folium.DivIcon(
+                html=preview_html,
+                icon_size=(160, 60),
+                icon_anchor=(80, 50),
+            )
+        ).add_to(m)
+
+    return m.get_root().render()
+
+def _map_fingerprint(*inputs):
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+def trip_map_html(places, segment_times, route, preview, center, zoom):
+    """메인 지도 HTML. 입력(장소, 구간 결과, 경로, 미리보기, 중심/줌)이 그대로면
+    다른 탭 조작으로 인한 재실행에서도 지도를 다시 만들지 않고 세션에 보관한 HTML을 재사용."""
+    fingerprint = _map_fingerprint(places, segment_times, route, preview, center, zoom)
+    memo = st.session_state.get('map_html')
+    if memo and memo[0] == fingerprint:
+        return memo[1]
+    html = build_map_html(places, segment_times, route, preview, center, zoom)
+    st.session_state['map_html'] = (fingerprint, html)
+    return html
+
 # --- 기본 체크리스트 항목 ---
 DEFAULT_CHECKLIST = [
     {"category": "여권/서류", "name": "여권", "checked": False},
@@ -282,10 +2579,58 @@ DEFAULT_CHECKLIST = [
 BUDGET_CATEGORIES = ["✈️ 항공", "🏨 숙소", "🍽️ 식비", "🎢 관광/액티비티", "🛍️ 쇼핑", "🚗 교통/렌터카", "💊 기타"]
 
 # --- 초기 세션 상태 설정 (Firebase에서 불러오기) ---
-if 'places' not in st.session_state:
-    st.session_state['places'] = load_places()
-if 'itinerary' not in st.session_state:
-    st.session_state['itinerary'] = load_itinerary()
+# 세션 키 → 저장 문서 매핑 (체크리스트는 한 문서에 두 사람 몫이 들어 있음)
+_SESSION_DOC_KEYS = {
+    'places': 'places',
+    'itinerary': 'itinerary',
+    'flights': 'flights',
+    'hotels': 'hotels',
+    'budget': 'budget',
+    'checklist_쏘야': 'checklist',
+    'checklist_병하': 'checklist',
+    'restaurants': 'restaurants',
+    'transports': 'transports',
+    'settings': 'settings',
+}
+
+def _apply_docs_to_session(decoded, versions, only_missing=False):
+    """디코딩된 문서를 세션 상태 키에 반영하고 본 버전을 기록."""
+    for key, doc_id in _SESSION_DOC_KEYS.items():
+        if doc_id not in decoded or (only_missing and key in st.session_state):
+            continue
+        value = decoded[doc_id]
+        if doc_id == 'checklist':
+            value = value[0] if key == 'checklist_쏘야' else value[1]
+        st.session_state[key] = value
+    st.session_state.setdefault('_doc_versions', {}).update(versions)
+
+_write_queue()  # 이전 실행에서 서버에 못 보낸 변경(로컬 로그)을 먼저 캐시에 반영
+if any(k not in st.session_state for k in _SESSION_DOC_KEYS):
+    # 첫 화면 전에 문서별 순차 요청 대신 배치 읽기 한 번
+    _apply_docs_to_session(*load_trip_snapshot(), only_missing=True)
+if st.session_state['budget'].get('expenses'):
+    migrate_expenses_to_ledger(st.session_state['budget'])
+
+@st.fragment(run_every="3s")
+def _watch_trip_updates():
+    """공유 저장소의 버전만 비교해서, 이 세션이 보는 문서가 바뀌었을 때만 전체 rerun."""
+    seen = st.session_state.get('_doc_versions', {})
+    latest = _trip_cache().versions(TRAVEL_DOCS + [d for d in seen if d.startswith(LEDGER_PREFIX)])
+    changed = [d for d, v in latest.items() if seen.get(d) != v]
+    if changed:
+        # 원장 문서는 세션에 복사해 두지 않고 렌더링 때 캐시에서 읽으므로 버전만 갱신
+        decoded, versions = load_trip_snapshot(changed)
+        _apply_docs_to_session(decoded, versions)
+        st.rerun()
+
+    # 저장 상태 표시 (저장 안 된 변경이 있을 때만)
+    queue = _write_queue()
+    unsaved = queue.pending_count()
+    if queue.last_error or _trip_cache().offline:
+        st.caption(f"📴 오프라인 — 이 기기에 저장된 사본 사용 중 (연결되면 변경 {queue.queued_ops()}건 자동 동기화)")
+    elif unsaved:
+        st.caption(f"💾 저장 안 된 변경 있음 (문서 {unsaved}개, 곧 자동 저장)")
+
 if 'search_candidates' not in st.session_state:
     st.session_state['search_candidates'] = []
 if 'preview_place' not in st.session_state:
@@ -302,24 +2647,10 @@ if 'segment_times_cache' not in st.session_state:
     st.session_state['segment_times_cache'] = {}
 if 'show_segment_times' not in st.session_state:
     st.session_state['show_segment_times'] = False
+if 'segment_geometry' not in st.session_state:
+    st.session_state['segment_geometry'] = True
 if 'map_center_place' not in st.session_state:
     st.session_state['map_center_place'] = None
-if 'flights' not in st.session_state:
-    st.session_state['flights'] = load_flights()
-if 'hotels' not in st.session_state:
-    st.session_state['hotels'] = load_hotels()
-if 'budget' not in st.session_state:
-    st.session_state['budget'] = load_budget()
-if 'checklist_쏘야' not in st.session_state or 'checklist_병하' not in st.session_state:
-    _cl_soya, _cl_byungha = load_checklist()
-    st.session_state['checklist_쏘야'] = _cl_soya
-    st.session_state['checklist_병하'] = _cl_byungha
-if 'restaurants' not in st.session_state:
-    st.session_state['restaurants'] = load_restaurants()
-if 'transports' not in st.session_state:
-    st.session_state['transports'] = load_transports()
-if 'settings' not in st.session_state:
-    st.session_state['settings'] = load_settings()
 if 'edit_itin_idx' not in st.session_state:
     st.session_state['edit_itin_idx'] = None
 if 'confirm_delete_idx' not in st.session_state:
@@ -410,7 +2741,43 @@ div[data-testid="stHorizontalBlock"]:hover
 """, unsafe_allow_html=True)
 
 # 사이드바
+@st.fragment(run_every="10s")
+def _maps_usage_panel():
+    """지도 API 엔드포인트별 오늘 사용량/한도와 캐시 적중률."""
+    governor = _quota_governor()
+    usage = governor.usage()
+    with st.expander("📊 지도 API 사용량"):
+        endpoints = sorted(set(governor.daily_caps) | set(usage))
+        st.dataframe(pd.DataFrame([{
+            "API": e,
+            "오늘": f"{usage.get(e, (0, 0))[0]:,}" + (f" / {governor.daily_caps[e]:,}" if e in governor.daily_caps else ""),
+            "최근 1분": usage.get(e, (0, 0))[1],
+            "한도 초과": governor.blocked.get(e, 0),
+        } for e in endpoints]), hide_index=True, use_container_width=True)
+
+        caches = {
+            "길찾기": _directions_cache(),
+            "이동 행렬": _matrix_cache(),
+            "장소 상세": _place_details_cache(),
+            "자동완성": _autocomplete_cache(),
+            "사진": _photo_cache(),
+        }
+        st.dataframe(pd.DataFrame([{
+            "캐시": name,
+            "적중률": f"{c.hits / (c.hits + c.misses):.0%}" if c.hits + c.misses else "-",
+            "조회": c.hits + c.misses,
+        } for name, c in caches.items()]), hide_index=True, use_container_width=True)
+        st.caption("적중률은 앱 프로세스 시작 이후 기준")
+
+        for host, s in http_pool_stats().items():
+            reuse = 1 - s['connections'] / s['requests'] if s['requests'] else 0
+            st.caption(f"🔌 {host}: 요청 {s['requests']:,}건 / 새 연결 {s['connections']}개 "
+                       f"(재사용 {reuse:.0%})")
+
 with st.sidebar:
+    # 다른 사용자의 변경 감지 (네트워크 요청 없이 메모리 버전만 비교)
+    _watch_trip_updates()
+
     # --- 디지털 시계 + 날씨: 미서부(LA) / 서울 ---
     components.html("""
     <style>
@@ -560,6 +2927,9 @@ with st.sidebar:
             unsafe_allow_html=True
         )
 
+    st.divider()
+    _maps_usage_panel()
+
 # 탭 구성
 tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs([
     "📅 일정 관리",
@@ -579,15 +2949,13 @@ with tab2:
             '<h3 style="margin:0 0 0.75rem 0; padding:0; font-size:1.25rem; font-weight:700; line-height:1.4;">📍 관광지 검색 및 추가</h3>',
             unsafe_allow_html=True
         )
+        if maps_degraded():
+            st.caption("⚠️ 지도 API 응답이 느려 일부 정보는 저장된 결과로 표시하고 있습니다.")
         search_query = st.text_input("관광지 이름을 영어 또는 한글로 입력하세요 (예: Grand Canyon, Las Vegas)")
 
         if st.button("🔍 검색") and search_query:
             try:
-                autocomplete_result = gmaps.places_autocomplete(
-                    search_query,
-                    language="ko",
-                    components={"country": "us"}
-                )
+                autocomplete_result = search_places(search_query)
             except Exception:
                 autocomplete_result = []
                 st.error("검색 중 오류가 발생했습니다. 잠시 후 다시 시도해 주세요.")
@@ -617,28 +2985,13 @@ with tab2:
             if current_preview is None or current_preview.get('place_id') != place_id:
                 place_detail = None
                 fetch_error = None
+                # 자동완성과 같은 세션 토큰으로 상세 조회 (세션은 여기서 끝남)
+                session_token = st.session_state.pop('places_session_token', None)
 
-                # 1차 시도: 전체 필드 요청
                 try:
-                    place_detail = gmaps.place(
-                        place_id,
-                        fields=['name', 'geometry', 'formatted_address', 'rating',
-                                'user_ratings_total', 'opening_hours', 'website',
-                                'international_phone_number', 'photos'],
-                        language="ko"
-                    )
+                    place_detail = get_place_details(place_id, session_token=session_token)
                 except ValueError:
-                    # 2차 시도: 기본 필드만 (API 등급/billing 제한 대응)
-                    try:
-                        place_detail = gmaps.place(
-                            place_id,
-                            fields=['name', 'geometry', 'formatted_address'],
-                            language="ko"
-                        )
-                    except ValueError:
-                        fetch_error = "api_error"
-                    except Exception:
-                        fetch_error = "network_error"
+                    fetch_error = "api_error"
                 except Exception:
                     fetch_error = "network_error"
 
@@ -649,19 +3002,15 @@ with tab2:
                     st.warning("⚠️ 네트워크 오류가 발생했습니다. 잠시 후 다시 시도해 주세요.")
                     st.session_state['preview_place'] = None
                 elif place_detail is not None:
-                    result = place_detail.get('result', {})
+                    result = place_detail
                     geometry = result.get('geometry', {}).get('location', {})
                     lat = geometry.get('lat')
                     lng = geometry.get('lng')
 
                     if result and lat and lng:
-                        # 대표 사진 URL 추출
-                        photo_url = None
+                        # 대표 사진 참조값 (사진은 로컬 캐시를 거쳐 표시)
                         photos = result.get('photos', [])
-                        if photos:
-                            photo_ref = photos[0].get('photo_reference')
-                            if photo_ref:
-                                photo_url = get_photo_url(photo_ref, max_width=400)
+                        photo_ref = photos[0].get('photo_reference') if photos else None
 
                         st.session_state['preview_place'] = {
                             'place_id': place_id,
@@ -674,7 +3023,7 @@ with tab2:
                             'opening_hours': result.get('opening_hours', {}).get('weekday_text', []),
                             'website': result.get('website', ''),
                             'phone': result.get('international_phone_number', ''),
-                            'photo_url': photo_url,
+                            'photo_ref': photo_ref,
                         }
                     else:
                         st.warning("⚠️ 이 장소의 위치 정보를 찾을 수 없습니다. 다른 검색 결과를 선택해 주세요.")
@@ -686,8 +3035,9 @@ with tab2:
                 st.divider()
 
                 # 사진 표시
-                if preview.get('photo_url'):
-                    st.image(preview['photo_url'], use_container_width=True)
+                _preview_photo = _photo_cache().path(preview['photo_ref']) if preview.get('photo_ref') else None
+                if _preview_photo:
+                    st.image(_preview_photo, use_container_width=True)
 
                 st.markdown(f"### 📌 {preview['name']}")
                 st.markdown(f"📍 {preview['address']}")
@@ -719,12 +3069,10 @@ with tab2:
                             'lat': preview['lat'],
                             'lng': preview['lng'],
                             'address': preview['address'],
-                            'photo_url': preview.get('photo_url', ''),
+                            'photo_ref': preview.get('photo_ref') or '',
                         }
                         st.session_state['places'].append(new_place)
-                        save_places(st.session_state['places'])
-                        # 세그먼트 캐시 초기화
-                        st.session_state['segment_times_cache'] = {}
+                        save_item_added("places", new_place)
                         st.session_state['search_candidates'] = []
                         st.session_state['preview_place'] = None
                         st.success(f"'{preview['name']}' 추가 완료!")
@@ -748,14 +3096,58 @@ with tab2:
                         st.rerun()
                 with c_del:
                     if st.button("🗑️", key=f"del_{i}"):
-                        st.session_state['places'].pop(i)
-                        save_places(st.session_state['places'])
-                        st.session_state['segment_times_cache'] = {}
+                        _removed = st.session_state['places'].pop(i)
+                        save_item_removed("places", _removed['id'])
                         st.session_state['map_center_place'] = None
                         st.rerun()
                 # 아이템 간 구분선
                 st.markdown("<div style='height:1px;background:#f3f4f6;margin:0 10px;'></div>", unsafe_allow_html=True)
 
+        # 방문 순서 최적화
+        if len(st.session_state['places']) >= 3:
+            with st.expander("🧭 방문 순서 최적화"):
+                _places = st.session_state['places']
+                _names = [p['name'] for p in _places]
+                opt_start = st.selectbox("출발지 (고정)", range(len(_places)),
+                                         format_func=lambda i: _names[i], key="opt_start")
+                opt_end = st.selectbox("도착지 (고정)", [None, *range(len(_places))],
+                                       format_func=lambda i: "지정 안 함" if i is None else _names[i], key="opt_end")
+                if st.button("최적 순서 계산", key="opt_route"):
+                    if opt_end == opt_start:
+                        st.warning("출발지와 도착지를 다르게 설정해 주세요.")
+                    else:
+                        with st.spinner("장소 간 이동 시간 조회 중..."):
+                            _matrix = travel_matrix(_places)
+                        _order = optimize_route(_matrix.durations, opt_start, opt_end)
+                        st.session_state['route_proposal'] = {
+                            'ids': [_places[i]['id'] for i in _order],
+                            'before': route_duration(_matrix.durations, list(range(len(_places)))),
+                            'after': route_duration(_matrix.durations, _order),
+                        }
+
+                proposal = st.session_state.get('route_proposal')
+                # 제안 이후 장소가 바뀌었으면 무시
+                if proposal and sorted(proposal['ids']) == sorted(p['id'] for p in _places):
+                    before, after = proposal['before'], proposal['after']
+                    if np.isnan(before) or np.isnan(after):
+                        st.warning("일부 구간은 경로를 찾을 수 없어 이동 시간을 비교할 수 없습니다.")
+                    elif before - after >= 60:
+                        st.success(f"총 이동 {_format_duration(before)} → {_format_duration(after)} "
+                                   f"(**{_format_duration(before - after)} 단축**)")
+                    else:
+                        st.info(f"지금 순서가 이미 최적에 가깝습니다 (총 이동 {_format_duration(before)}).")
+                    _by_id = {p['id']: p for p in _places}
+                    st.markdown(" → ".join(_by_id[i]['name'] for i in proposal['ids']))
+                    c_apply, c_cancel = st.columns(2)
+                    if c_apply.button("이 순서로 변경", type="primary", key="opt_apply"):
+                        st.session_state['places'] = [_by_id[i] for i in proposal['ids']]
+                        save_items_reordered("places", st.session_state['places'])
+                        st.session_state['route_proposal'] = None
+                        st.rerun()
+                    if c_cancel.button("취소", key="opt_cancel"):
+                        st.session_state['route_proposal'] = None
+                        st.rerun()
+
         # 이동 시간 계산기
         st.divider()
         st.subheader("⏱️ 차량 이동 시간 계산")
@@ -769,37 +3161,27 @@ with tab2:
                     start_place = next(p for p in st.session_state['places'] if p['name'] == start_point)
                     end_place = next(p for p in st.session_state['places'] if p['name'] == end_point)
 
-                    _now = datetime.now()
-                    directions = gmaps.directions(
-                        (start_place['lat'], start_place['lng']),
-                        (end_place['lat'], end_place['lng']),
-                        mode="driving",
-                        language="ko",
-                        departure_time=_now,
-                    )
-                    if not directions:
-                        directions = gmaps.directions(
-                            start_place['address'],
-                            end_place['address'],
-                            mode="driving",
-                            language="ko",
-                            departure_time=_now,
-                        )
-                    if directions:
-                        leg = directions[0]['legs'][0]
-                        duration_text = leg.get('duration_in_traffic', leg['duration'])['text']
+                    route, failed = None, True
+                    try:
+                        route = get_directions(start_place, end_place)
+                        failed = False
+                    except MapsUnavailable:
+                        st.warning("⚠️ 지도 API 응답이 원활하지 않습니다. 잠시 후 다시 시도해 주세요.")
+                    except Exception:
+                        st.error("경로 계산 중 오류가 발생했습니다. 잠시 후 다시 시도해 주세요.")
+                    if route:
                         st.session_state['route_result'] = {
                             'start': start_point,
                             'end': end_point,
-                            'duration': duration_text,
-                            'distance': leg['distance']['text'],
+                            'duration': route['duration'],
+                            'distance': route['distance'],
                         }
-                        st.session_state['route_polyline'] = directions[0]['overview_polyline']['points']
+                        st.session_state['route_polyline'] = route['polyline']
                         st.session_state['route_start'] = start_place
                         st.session_state['route_end'] = end_place
                         st.session_state['map_center_place'] = None
                         st.rerun()
-                    else:
+                    elif not failed:
                         st.error("두 지점 간의 경로를 찾을 수 없습니다.")
                 else:
                     st.warning("출발지와 도착지를 다르게 설정해 주세요.")
@@ -813,8 +3195,13 @@ with tab2:
                 if st.button("계산" if not st.session_state['show_segment_times'] else "숨기기", type="primary"):
                     st.session_state['show_segment_times'] = not st.session_state['show_segment_times']
                     if st.session_state['show_segment_times']:
-                        st.session_state['segment_times_cache'] = {}
+                        # 실패했던 구간만 다시 조회
+                        st.session_state['segment_times_cache'] = {
+                            k: v for k, v in st.session_state['segment_times_cache'].items() if v is not None
+                        }
                     st.rerun()
+            if st.session_state['show_segment_times']:
+                st.checkbox("실제 도로 경로로 그리기 (끄면 직선 연결, 경로 조회 없음)", key="segment_geometry")
         else:
             st.info("이동 시간을 계산하려면 지도에 관광지를 2개 이상 추가해 주세요.")
 
@@ -852,293 +3239,21 @@ with tab2:
             map_center = [36.1699, -115.1398]
             map_zoom = 6
 
-        m = folium.Map(
-            location=map_center,
-            zoom_start=map_zoom,
-            tiles="http://mt0.google.com/vt/lyrs=m&hl=ko&x={x}&y={y}&z={z}",
-            attr="Google",
-            name="Google Maps"
-        )
-
-        # 팔레트: 지점 번호별 색상
-        COLORS = ["#FF6B6B", "#FF9F43", "#F7B731", "#26de81", "#45aaf2",
-                  "#a55eea", "#fd9644", "#2bcbba", "#fc5c65", "#4b7bec"]
-
-        coordinates = []
-
         # --- 세그먼트 이동시간 계산 (show_segment_times ON일 때) ---
         segment_times = []
         if st.session_state.get('show_segment_times') and len(st.session_state['places']) >= 2:
             with st.spinner("구간별 이동시간 계산 중..."):
-                segment_times = get_segment_times(st.session_state['places'])
-
-        # --- 세그먼트 폴리라인 & 시간 라벨 ---
-        if segment_times:
-            for i, seg in enumerate(segment_times):
-                if seg is None:
-                    continue
-                a = st.session_state['places'][i]
-                b = st.session_state['places'][i + 1]
-                seg_color = COLORS[i % len(COLORS)]
-
-                # 세그먼트 경로 그리기
-                decoded = polyline_decoder.decode(seg['polyline'])
-                full_seg = [[a['lat'], a['lng']]] + decoded + [[b['lat'], b['lng']]]
-                folium.PolyLine(
-                    locations=full_seg,
-                    color=seg_color,
-                    weight=5,
-                    opacity=0.85,
-                    tooltip=f"🚗 {seg['duration']} ({seg['distance']})"
-                ).add_to(m)
-
-                # 중간 지점에 이동시간 라벨 표시
-                mid_lat = seg['mid_lat']
-                mid_lng = seg['mid_lng']
-                label_html = f"""
-                <div style="
-                    background: {seg_color};
-                    color: white;
-                    padding: 4px 8px;
-                    border-radius: 12px;
-                    font-size: 12px;
-                    font-weight: bold;
-                    font-family: 'Noto Sans KR', sans-serif;
-                    white-space: nowrap;
-                    box-shadow: 0 2px 6px rgba(0,0,0,0.3);
-                    border: 2px solid white;
-                ">🚗 {seg['duration']}</div>
-                """
-                folium.Marker(
-                    location=[mid_lat, mid_lng],
-                    icon=folium.DivIcon(
-                        html=label_html,
-                        icon_size=(120, 30),
-                        icon_anchor=(60, 15),
-                    )
-                ).add_to(m)
-
-        # --- 단순 연결선 (세그먼트 없을 때, 경로 계산 결과 있을 때 제외) ---
-        for place in st.session_state['places']:
-            coordinates.append([place['lat'], place['lng']])
-
-        if not segment_times and not st.session_state.get('route_polyline'):
-            if len(coordinates) >= 2:
-                folium.PolyLine(
-                    locations=coordinates,
-                    color="#74b9ff",
-                    weight=3,
-                    opacity=0.6,
-                    dash_array="8"
-                ).add_to(m)
-
-        # 경로 계산 결과 폴리라인 (특정 구간 경로)
-        if st.session_state.get('route_polyline') and st.session_state.get('route_start') and st.session_state.get('route_end'):
-            decoded = polyline_decoder.decode(st.session_state['route_polyline'])
-            rs = st.session_state['route_start']
-            re_place = st.session_state['route_end']
-            full_route = [[rs['lat'], rs['lng']]] + decoded + [[re_place['lat'], re_place['lng']]]
-            folium.PolyLine(
-                locations=full_route,
-                color="#0652DD",
-                weight=5,
-                opacity=0.9,
-                tooltip="최적 경로"
-            ).add_to(m)
-
-        # --- 커스텀 마커 (사진 + 번호 배지) ---
-        for i, place in enumerate(st.session_state['places']):
-            color = COLORS[i % len(COLORS)]
-            photo_url = place.get('photo_url', '')
-            name = place['name']
-
-            if photo_url:
-                # 사진 + 번호 배지 마커
-                marker_html = f"""
-                <div style="
-                    position: relative;
-                    width: 64px;
-                    text-align: center;
-                    font-family: 'Noto Sans KR', sans-serif;
-                ">
-                    <div style="
-                        width: 60px;
-                        height: 60px;
-                        border-radius: 50%;
-                        overflow: hidden;
-                        border: 3px solid {color};
-                        box-shadow: 0 3px 10px rgba(0,0,0,0.4);
-                        background: white;
-                    ">
-                        <img src="{photo_url}"
-                             style="width:100%; height:100%; object-fit:cover;"
-                             onerror="this.style.display='none'; this.parentElement.style.background='{color}';"
-                        />
-                    </div>
-                    <div style="
-                        position: absolute;
-                        top: -6px;
-                        right: -4px;
-                        width: 22px;
-                        height: 22px;
-                        background: {color};
-                        color: white;
-                        border-radius: 50%;
-                        font-size: 11px;
-                        font-weight: bold;
-                        line-height: 22px;
-                        border: 2px solid white;
-                        box-shadow: 0 1px 4px rgba(0,0,0,0.3);
-                    ">{i+1}</div>
-                    <div style="
-                        margin-top: 3px;
-                        background: {color};
-                        color: white;
-                        padding: 2px 6px;
-                        border-radius: 8px;
-                        font-size: 10px;
-                        font-weight: bold;
-                        white-space: nowrap;
-                        overflow: hidden;
-                        text-overflow: ellipsis;
-                        max-width: 80px;
-                        box-shadow: 0 1px 4px rgba(0,0,0,0.2);
-                    ">{name[:10]}{'...' if len(name) > 10 else ''}</div>
-                    <div style="
-                        width: 0;
-                        height: 0;
-                        border-left: 8px solid transparent;
-                        border-right: 8px solid transparent;
-                        border-top: 10px solid {color};
-                        margin: 0 auto;
-                    "></div>
-                </div>
-                """
-                popup_html = f"""
-                <div style="font-family: 'Noto Sans KR', sans-serif; min-width: 180px;">
-                    <img src="{photo_url}" style="width:100%; border-radius:8px; margin-bottom:8px;"
-                         onerror="this.style.display='none';" />
-                    <div style="font-weight:bold; font-size:14px; color:{color};">📍 {name}</div>
-                    <div style="font-size:11px; color:#666; margin-top:4px;">{place.get('address','')}</div>
-                </div>
-                """
-            else:
-                # 사진 없을 때: 색상 원형 번호 마커
-                marker_html = f"""
-                <div style="
-                    position: relative;
-                    text-align: center;
-                    font-family: 'Noto Sans KR', sans-serif;
-                ">
-                    <div style="
-                        width: 44px;
-                        height: 44px;
-                        background: {color};
-                        border-radius: 50%;
-                        border: 3px solid white;
-                        box-shadow: 0 3px 10px rgba(0,0,0,0.4);
-                        display: flex;
-                        align-items: center;
-                        justify-content: center;
-                        color: white;
-                        font-size: 18px;
-                        font-weight: bold;
-                        margin: 0 auto;
-                    ">{i+1}</div>
-                    <div style="
-                        margin-top: 3px;
-                        background: {color};
-                        color: white;
-                        padding: 2px 6px;
-                        border-radius: 8px;
-                        font-size: 10px;
-                        font-weight: bold;
-                        white-space: nowrap;
-                        box-shadow: 0 1px 4px rgba(0,0,0,0.2);
-                    ">{name[:10]}{'...' if len(name) > 10 else ''}</div>
-                    <div style="
-                        width: 0;
-                        height: 0;
-                        border-left: 8px solid transparent;
-                        border-right: 8px solid transparent;
-                        border-top: 10px solid {color};
-                        margin: 0 auto;
-                    "></div>
-                </div>
-                """
-                popup_html = f"""
-                <div style="font-family: 'Noto Sans KR', sans-serif; min-width: 150px;">
-                    <div style="font-weight:bold; font-size:14px; color:{color};">📍 {name}</div>
-                    <div style="font-size:11px; color:#666; margin-top:4px;">{place.get('address','')}</div>
-                </div>
-                """
-
-            folium.Marker(
-                location=[place['lat'], place['lng']],
-                popup=folium.Popup(popup_html, max_width=220),
-                tooltip=f"{i+1}. {name}",
-                icon=folium.DivIcon(
-                    html=marker_html,
-                    icon_size=(90, 100),
-                    icon_anchor=(45, 80),
+                segment_times = get_segment_times(
+                    st.session_state['places'], with_geometry=st.session_state['segment_geometry']
                 )
-            ).add_to(m)
 
-        # --- 미리보기 마커 (초록색 핀) ---
-        if preview:
-            preview_html = f"""
-            <div style="
-                text-align: center;
-                font-family: 'Noto Sans KR', sans-serif;
-            ">
-                <div style="
-                    background: #00b894;
-                    color: white;
-                    padding: 6px 10px;
-                    border-radius: 10px;
-                    font-size: 11px;
-                    font-weight: bold;
-                    box-shadow: 0 3px 8px rgba(0,0,0,0.3);
-                    border: 2px solid white;
-                    white-space: nowrap;
-                ">📍 {preview['name'][:15]}{'...' if len(preview['name']) > 15 else ''}<br><span style="font-size:9px; opacity:0.9;">미리보기</span></div>
-                <div style="
-                    width: 0;
-                    height: 0;
-                    border-left: 8px solid transparent;
-                    border-right: 8px solid transparent;
-                    border-top: 10px solid #00b894;
-                    margin: 0 auto;
-                "></div>
-            </div>
-            """
-            popup_html = f"""
-            <div style="font-family: 'Noto Sans KR', sans-serif; min-width: 150px;">
-                <div style="font-weight:bold; font-size:14px; color:#00b894;">📍 {preview['name']}</div>
-                <div style="font-size:11px; color:#666; margin-top:4px;">{preview.get('address','')}</div>
-            </div>
-            """
-            if preview.get('photo_url'):
-                popup_html = f"""
-                <div style="font-family: 'Noto Sans KR', sans-serif; min-width: 180px;">
-                    <img src="{preview['photo_url']}" style="width:100%; border-radius:8px; margin-bottom:8px;"
-                         onerror="this.style.display='none';" />
-                    <div style="font-weight:bold; font-size:14px; color:#00b894;">📍 {preview['name']}</div>
-                    <div style="font-size:11px; color:#666; margin-top:4px;">{preview.get('address','')}</div>
-                </div>
-                """
-            folium.Marker(
-                location=[preview['lat'], preview['lng']],
-                popup=folium.Popup(popup_html, max_width=220),
-                tooltip=f"📍 {preview['name']} (미리보기)",
-                icon=folium.DivIcon(
-                    html=preview_html,
-                    icon_size=(160, 60),
-                    icon_anchor=(80, 50),
-                )
-            ).add_to(m)
-
-        st_folium(m, width=800, height=600, key="main_map")
+        route = None
+        if st.session_state.get('route_polyline'):
+            route = (st.session_state['route_polyline'], st.session_state.get('route_start'), st.session_state.get('route_end'))
+        components.html(
+            trip_map_html(st.session_state['places'], segment_times, route, preview, map_center, map_zoom),
+            height=600,
+        )
 
         # 구간별 이동시간 요약 테이블
         if segment_times and any(s for s in segment_times):
@@ -1161,24 +3276,20 @@ with tab1:
     st.header("📅 세부 일정 관리")
 
     df_itin = st.session_state['itinerary']
+    # 타입 있는 일정을 시작 시각 순으로 정렬하고, 표시용 문자열은 벡터 연산으로 한 번에 만듦
+    sorted_itin = df_itin.sort_values(by='시작')
+    _itin_str = _itinerary_strings(sorted_itin)
 
     # ── 1. 인터랙티브 달력 뷰 ─────────────────────────────────────────
-    _has_end = '종료날짜' in df_itin.columns
-    _ev_list = []
-    for _ei, _er in df_itin.iterrows():
-        _end_d = ''
-        if _has_end:
-            _v = _er['종료날짜']
-            _end_d = str(_v) if (pd.notna(_v) and str(_v).strip() not in ('', 'nan')) else ''
-        _ev_list.append({
-            'idx': int(_ei),
-            'start_date': str(_er['날짜']),
-            'end_date': _end_d if _end_d else str(_er['날짜']),
-            'start_time': str(_er['시작시간']),
-            'end_time': str(_er['종료시간']),
-            'activity': str(_er['장소 및 활동']),
-            'memo': str(_er.get('메모', '') or ''),
-        })
+    _ev_list = pd.DataFrame({
+        'idx': _itin_str.index.astype(str),
+        'start_date': _itin_str['날짜'],
+        'end_date': _itin_str['종료날짜'].where(_itin_str['종료날짜'] != '', _itin_str['날짜']),
+        'start_time': _itin_str['시작시간'],
+        'end_time': _itin_str['종료시간'],
+        'activity': _itin_str['장소 및 활동'],
+        'memo': _itin_str['메모'],
+    }).to_dict(orient='records')
     _ev_json = json.dumps(_ev_list, ensure_ascii=False)
 
     _CAL_HTML = r"""<!DOCTYPE html>
@@ -1306,12 +3417,10 @@ render(Y,M);
 
     # ── 달력에서 수정할 일정 선택 ──
     if not df_itin.empty:
-        _sorted_ev = df_itin.sort_values(by=['날짜', '시작시간'])
-        _ev_labels = ["-- 일정을 선택하여 수정하기 --"] + [
-            f"{_er['날짜']} {_er['시작시간']} | {str(_er['장소 및 활동'])[:30]}"
-            for _, _er in _sorted_ev.iterrows()
-        ]
-        _ev_indices = [None] + list(_sorted_ev.index)
+        _ev_labels = ["-- 일정을 선택하여 수정하기 --"] + (
+            _itin_str['날짜'] + " " + _itin_str['시작시간'] + " | " + _itin_str['장소 및 활동'].str[:30]
+        ).tolist()
+        _ev_indices = [None] + list(_itin_str.index)
         _cal_sel = st.selectbox(
             "✏️ 달력에서 수정할 일정 선택",
             _ev_labels,
@@ -1330,8 +3439,6 @@ render(Y,M);
 
     with st.expander("📋 표로 보기", expanded=False):
         if not df_itin.empty:
-            sorted_itin = df_itin.sort_values(by=['날짜', '시작시간'])
-
             # 헤더 행 (데이터와 동일 비율)
             _hcols = st.columns(_COL_W)
             for _hc, _hl in zip(_hcols, ["날짜 / 기간", "시간", "장소 및 활동", "메모", "", ""]):
@@ -1343,12 +3450,9 @@ render(Y,M);
                 )
 
             _prev_date = None
-            for _oi, _row in sorted_itin.iterrows():
+            for _oi, _row in _itin_str.iterrows():
                 _rd = _row['날짜']
-                _ed2 = ''
-                if _has_end:
-                    _vv = _row['종료날짜']
-                    _ed2 = str(_vv) if (pd.notna(_vv) and str(_vv).strip() not in ('', 'nan')) else ''
+                _ed2 = _row['종료날짜']
                 _date_lbl = _rd if (not _ed2 or _ed2 == _rd) else f"{_rd}~{_ed2}"
                 _new_date = (_rd != _prev_date)
                 _prev_date = _rd
@@ -1373,7 +3477,7 @@ render(Y,M);
                     unsafe_allow_html=True,
                 )
                 _dcols[3].markdown(
-                    f"<div style='{_cs}color:#888;'>{_row.get('메모','') or ''}</div>",
+                    f"<div style='{_cs}color:#888;'>{_row['메모']}</div>",
                     unsafe_allow_html=True,
                 )
                 with _dcols[4]:
@@ -1384,11 +3488,9 @@ render(Y,M);
                 with _dcols[5]:
                     if st.session_state.get('confirm_delete_idx') == _oi:
                         if st.button("✅", key=f"confirm_del_{_oi}", use_container_width=True, help="삭제 확인"):
-                            st.session_state['itinerary'] = (
-                                st.session_state['itinerary'].drop(_oi).reset_index(drop=True)
-                            )
+                            st.session_state['itinerary'] = st.session_state['itinerary'].drop(_oi)
                             st.session_state['confirm_delete_idx'] = None
-                            save_itinerary(st.session_state['itinerary'])
+                            save_item_removed("itinerary", _oi)
                             st.rerun()
                     else:
                         if st.button("🗑️", key=f"del_itin_{_oi}", use_container_width=True, help="삭제"):
@@ -1403,7 +3505,7 @@ render(Y,M);
                     st.rerun()
 
             st.divider()
-            _csv = sorted_itin.reset_index(drop=True).to_csv(index=False).encode('utf-8')
+            _csv = _itin_str.reset_index(drop=True).to_csv(index=False).encode('utf-8')
             st.download_button(
                 label="📥 CSV로 일정 다운로드",
                 data=_csv,
@@ -1420,26 +3522,12 @@ render(Y,M);
         st.markdown("---")
         st.subheader("✏️ 일정 수정")
 
-        try:
-            _ed_start = date_type.fromisoformat(str(_edit_row['날짜']))
-        except Exception:
-            _ed_start = date_type(2026, 5, 1)
-
-        _ed_end_str = str(_edit_row.get('종료날짜', '') or '').strip()
-        try:
-            _ed_end = date_type.fromisoformat(_ed_end_str) if _ed_end_str and _ed_end_str != 'nan' else _ed_start
-        except Exception:
-            _ed_end = _ed_start
-
-        try:
-            _ed_st = datetime.strptime(str(_edit_row['시작시간']), "%H:%M").time()
-        except Exception:
-            _ed_st = datetime.strptime("09:00", "%H:%M").time()
-
-        try:
-            _ed_et = datetime.strptime(str(_edit_row['종료시간']), "%H:%M").time()
-        except Exception:
-            _ed_et = datetime.strptime("10:00", "%H:%M").time()
+        # 타입 컬럼이라 문자열 파싱 없이 바로 꺼냄 (날짜가 없던 행만 기본값)
+        _has_start = pd.notna(_edit_row['시작'])
+        _ed_start = _edit_row['시작'].date() if _has_start else date_type(2026, 5, 1)
+        _ed_end = _edit_row['종료날짜'].date() if pd.notna(_edit_row['종료날짜']) else _ed_start
+        _ed_st = _edit_row['시작'].time() if _has_start else datetime.strptime("09:00", "%H:%M").time()
+        _ed_et = _edit_row['종료'].time() if pd.notna(_edit_row['종료']) else datetime.strptime("10:00", "%H:%M").time()
 
         with st.form("edit_itinerary_form"):
             _efc1, _efc2 = st.columns(2)
@@ -1452,19 +3540,20 @@ render(Y,M);
                 _e_start_time = st.time_input("시작 시간", value=_ed_st, key="edit_start_time")
             with _efc4:
                 _e_end_time = st.time_input("종료 시간", value=_ed_et, key="edit_end_time")
-            _e_activity = st.text_input("장소 및 활동", value=str(_edit_row['장소 및 활동']), key="edit_activity")
-            _e_memo = st.text_area("메모", value=str(_edit_row.get('메모', '') or ''), key="edit_memo")
+            _e_activity = st.text_input("장소 및 활동", value=_edit_row['장소 및 활동'], key="edit_activity")
+            _e_memo = st.text_area("메모", value=_edit_row['메모'], key="edit_memo")
             _e_submitted = st.form_submit_button("💾 수정 저장", use_container_width=True, type="primary")
 
             if _e_submitted and _e_activity:
-                _end_d_str2 = str(_e_end_date) if str(_e_end_date) != str(_e_start_date) else ''
-                st.session_state['itinerary'].at[_edit_idx, '날짜'] = str(_e_start_date)
-                st.session_state['itinerary'].at[_edit_idx, '종료날짜'] = _end_d_str2
-                st.session_state['itinerary'].at[_edit_idx, '시작시간'] = _e_start_time.strftime("%H:%M")
-                st.session_state['itinerary'].at[_edit_idx, '종료시간'] = _e_end_time.strftime("%H:%M")
-                st.session_state['itinerary'].at[_edit_idx, '장소 및 활동'] = _e_activity
-                st.session_state['itinerary'].at[_edit_idx, '메모'] = _e_memo
-                save_itinerary(st.session_state['itinerary'])
+                _itin = st.session_state['itinerary']
+                _itin.at[_edit_idx, '시작'] = pd.Timestamp(datetime.combine(_e_start_date, _e_start_time))
+                _itin.at[_edit_idx, '종료'] = pd.Timestamp(datetime.combine(_e_end_date, _e_end_time))
+                _itin.at[_edit_idx, '종료날짜'] = pd.Timestamp(_e_end_date) if _e_end_date != _e_start_date else pd.NaT
+                _itin.at[_edit_idx, '장소 및 활동'] = _e_activity
+                _itin.at[_edit_idx, '메모'] = _e_memo
+                _itin.at[_edit_idx, '_원본'] = None  # 날짜/시간을 폼에서 새로 정했으므로 원래 문자열은 버림
+                save_item_updated("itinerary", _edit_idx,
+                                  _itinerary_record(st.session_state['itinerary'], _edit_idx))
                 st.session_state['edit_itin_idx'] = None
                 st.session_state['itin_edit_success'] = True
                 st.rerun()
@@ -1508,19 +3597,17 @@ render(Y,M);
 
         if _submitted and _activity:
             _end_d_str = str(_end_date) if str(_end_date) != str(_start_date) else ''
-            _new_row = pd.DataFrame({
-                '날짜': [str(_start_date)],
-                '종료날짜': [_end_d_str],
-                '시작시간': [_start_time.strftime("%H:%M")],
-                '종료시간': [_end_time.strftime("%H:%M")],
-                '장소 및 활동': [_activity],
-                '메모': [_memo],
-            })
-            _cur_df = st.session_state['itinerary']
-            if '종료날짜' not in _cur_df.columns:
-                _cur_df['종료날짜'] = ''
-            st.session_state['itinerary'] = pd.concat([_cur_df, _new_row], ignore_index=True)
-            save_itinerary(st.session_state['itinerary'])
+            _new_id = _new_item_id()
+            _new_row = _itinerary_frame([{
+                '날짜': str(_start_date),
+                '종료날짜': _end_d_str,
+                '시작시간': _start_time.strftime("%H:%M"),
+                '종료시간': _end_time.strftime("%H:%M"),
+                '장소 및 활동': _activity,
+                '메모': _memo,
+            }], [_new_id])
+            st.session_state['itinerary'] = pd.concat([st.session_state['itinerary'], _new_row])
+            save_item_added("itinerary", dict(_itinerary_record(st.session_state['itinerary'], _new_id), id=_new_id))
             st.session_state['itin_success'] = True   # 완료 플래그 세팅
             st.rerun()
         elif _submitted and not _activity:
@@ -1568,7 +3655,7 @@ with tab3:
                     "seat": f_seat, "confirmation": f_confirm, "memo": f_memo,
                 }
                 st.session_state['flights'].append(new_flight)
-                save_flights(st.session_state['flights'])
+                save_item_added("flights", new_flight)
                 st.success(f"'{f_airline} {f_no}' 항공편이 추가되었습니다!")
                 st.rerun()
             elif f_submitted:
@@ -1602,8 +3689,8 @@ with tab3:
                     </div>""", unsafe_allow_html=True)
                 with c_del:
                     if st.button("🗑️", key=f"del_flight_{i}", use_container_width=True):
-                        st.session_state['flights'].pop(i)
-                        save_flights(st.session_state['flights'])
+                        _removed = st.session_state['flights'].pop(i)
+                        save_item_removed("flights", _removed['id'])
                         st.rerun()
         else:
             st.info("아직 등록된 항공편이 없습니다.")
@@ -1650,7 +3737,7 @@ with tab3:
                     "confirmation": t_confirm, "price": t_price, "memo": t_memo,
                 }
                 st.session_state['transports'].append(new_transport)
-                save_transports(st.session_state['transports'])
+                save_item_added("transports", new_transport)
                 st.success(f"'{t_type}' 교통편이 추가되었습니다!")
                 st.rerun()
             elif t_submitted:
@@ -1684,8 +3771,8 @@ with tab3:
                     </div>""", unsafe_allow_html=True)
                 with c_del:
                     if st.button("🗑️", key=f"del_transport_{i}", use_container_width=True):
-                        st.session_state['transports'].pop(i)
-                        save_transports(st.session_state['transports'])
+                        _removed = st.session_state['transports'].pop(i)
+                        save_item_removed("transports", _removed['id'])
                         st.rerun()
         else:
             st.info("아직 등록된 교통편이 없습니다.")
@@ -1715,7 +3802,7 @@ with tab4:
                 "nights": nights, "confirmation": h_confirm, "memo": h_memo,
             }
             st.session_state['hotels'].append(new_hotel)
-            save_hotels(st.session_state['hotels'])
+            save_item_added("hotels", new_hotel)
             st.success(f"'{h_name}' 숙소가 추가되었습니다!")
             st.rerun()
         elif h_submitted:
@@ -1748,7 +3835,7 @@ with tab4:
             with c_del:
                 if st.button("🗑️", key=f"del_hotel_{i}", use_container_width=True):
                     st.session_state['hotels'].pop(orig_i)
-                    save_hotels(st.session_state['hotels'])
+                    save_item_removed("hotels", ht['id'])
                     st.rerun()
     else:
         st.info("아직 등록된 숙소가 없습니다.")
@@ -1761,8 +3848,8 @@ with tab5:
     budget_data = st.session_state['budget']
     if "planned" not in budget_data:
         budget_data["planned"] = {}
-    if "expenses" not in budget_data:
-        budget_data["expenses"] = []
+    if "ledger_summary" not in budget_data:
+        budget_data["ledger_summary"] = {}
     for cat in BUDGET_CATEGORIES:
         if cat not in budget_data["planned"]:
             budget_data["planned"][cat] = 0
@@ -1782,11 +3869,11 @@ with tab5:
         e_desc = st.text_input("내용", placeholder="예: 대한항공 항공권, 저녁 식사 등")
         if st.form_submit_button("💾 지출 추가"):
             if e_amount > 0:
-                st.session_state['budget']['expenses'].append({
+                _new_exp = {
                     "date": str(e_date), "category": e_cat,
                     "person": e_person, "amount": int(e_amount), "description": e_desc,
-                })
-                save_budget(st.session_state['budget'])
+                }
+                add_expense(st.session_state['budget'], _new_exp)
                 st.success(f"지출 {e_amount:,}원이 추가되었습니다!")
                 st.rerun()
             else:
@@ -1807,21 +3894,22 @@ with tab5:
                     )
             if st.form_submit_button("💾 예산 저장"):
                 st.session_state['budget']['planned'] = new_planned
-                save_budget(st.session_state['budget'])
+                _write_doc("budget", {"planned": new_planned}, merge=True)
                 st.success("예산이 저장되었습니다!")
                 st.rerun()
 
     st.divider()
 
-    # ── 요약 카드 ────────────────────────────────────
-    expenses = budget_data.get("expenses", [])
+    # ── 요약 카드 (월별 요약만 사용, 지출 내역은 읽지 않음) ──────────
+    ledger_summary = budget_data.get("ledger_summary", {})
+    totals = ledger_totals(ledger_summary)
     planned = budget_data.get("planned", {})
     total_planned = sum(planned.values())
-    total_actual = sum(e["amount"] for e in expenses)
+    total_actual = totals["total"]
     remaining = total_planned - total_actual
-    soya_total = sum(e["amount"] for e in expenses if e.get("person") == "쏘야")
-    byungha_total = sum(e["amount"] for e in expenses if e.get("person") == "병하")
-    common_total = sum(e["amount"] for e in expenses if e.get("person") == "공통")
+    soya_total = totals["by_person"].get("쏘야", 0)
+    byungha_total = totals["by_person"].get("병하", 0)
+    common_total = totals["by_person"].get("공통", 0)
 
     r1, r2, r3 = st.columns(3)
     r1.markdown(f"""<div style="background:linear-gradient(135deg,#667eea,#764ba2);color:white;
@@ -1862,13 +3950,21 @@ with tab5:
     st.divider()
 
     # ── 뷰 탭 ─────────────────────────────────────────
+    # 날짜별/목록 보기는 선택한 달의 원장만 읽음
+    _months = ledger_months(ledger_summary)
+    if _months:
+        _sel_month = st.selectbox("📅 지출 내역 월 선택", _months, index=len(_months) - 1, key="budget_month")
+        expenses = load_ledger(_sel_month)
+    else:
+        expenses = []
+
     bv1, bv2, bv3 = st.tabs(["📊 카테고리별", "📅 날짜별", "📋 전체 목록"])
 
     with bv1:
-        if total_planned > 0 or expenses:
+        if total_planned > 0 or total_actual:
             for cat in BUDGET_CATEGORIES:
                 p = planned.get(cat, 0)
-                a = sum(e["amount"] for e in expenses if e.get("category") == cat)
+                a = totals["by_category"].get(cat, 0)
                 if p == 0 and a == 0:
                     continue
                 pct = min(int(a / p * 100), 100) if p > 0 else 0
@@ -1914,7 +4010,6 @@ with tab5:
                 _c.markdown(f"<small style='color:#999;font-weight:600;'>{_l}</small>", unsafe_allow_html=True)
             st.markdown("<hr style='margin:2px 0 4px 0;border-color:#ebebeb;'>", unsafe_allow_html=True)
             for ei, e in enumerate(filtered):
-                orig_i = expenses.index(e)
                 _pc = "#ef4444" if e.get("person") == "쏘야" else "#3b82f6" if e.get("person") == "병하" else "#22c55e"
                 ec0, ec1, ec2, ec3, ec4, ec5 = st.columns([1.5, 2, 1.2, 1.8, 2, 0.8])
                 ec0.markdown(f"<span style='font-size:13px;'>{e.get('date','')}</span>", unsafe_allow_html=True)
@@ -1923,9 +4018,8 @@ with tab5:
                 ec3.markdown(f"<span style='font-size:13px;font-weight:600;'>{int(e.get('amount',0)):,}원</span>", unsafe_allow_html=True)
                 ec4.markdown(f"<span style='font-size:12px;color:#777;'>{e.get('description','')}</span>", unsafe_allow_html=True)
                 with ec5:
-                    if st.button("🗑️", key=f"del_exp_{orig_i}", use_container_width=True):
-                        st.session_state['budget']['expenses'].pop(orig_i)
-                        save_budget(st.session_state['budget'])
+                    if st.button("🗑️", key=f"del_exp_{e['id']}", use_container_width=True):
+                        void_expense(st.session_state['budget'], e)
                         st.rerun()
         else:
             st.info("아직 등록된 지출이 없습니다.")
@@ -1934,6 +4028,11 @@ with tab5:
 with tab6:
     st.header("📋 준비물 체크리스트")
 
+    def _on_checklist_toggle(person, idx):
+        items = st.session_state[f'checklist_{person}']
+        items[idx]['checked'] = st.session_state[f"cl_{person}_{idx}"]
+        save_checklist(person, items)
+
     def _render_checklist(person):
         cl_items = st.session_state.get(f'checklist_{person}', [])
         total_items = len(cl_items)
@@ -1961,14 +4060,12 @@ with tab6:
             with st.expander(f"**{cat}** ({cat_checked}/{len(cat_items)})", expanded=True):
                 for idx, it in cat_items:
                     cl1, cl2 = st.columns([10, 1], vertical_alignment="center")
-                    new_val = cl1.checkbox(
+                    # on_change 콜백은 스크립트 실행 전에 처리되므로 추가 rerun이 필요 없음
+                    cl1.checkbox(
                         it.get('name', ''), value=it.get('checked', False),
-                        key=f"cl_{person}_{idx}"
+                        key=f"cl_{person}_{idx}",
+                        on_change=_on_checklist_toggle, args=(person, idx),
                     )
-                    if new_val != it.get('checked', False):
-                        st.session_state[f'checklist_{person}'][idx]['checked'] = new_val
-                        save_checklist(person, st.session_state[f'checklist_{person}'])
-                        st.rerun()
                     with cl2:
                         if st.button("🗑️", key=f"del_cl_{person}_{idx}", use_container_width=True):
                             st.session_state[f'checklist_{person}'].pop(idx)
@@ -2035,7 +4132,7 @@ with tab7:
                 "city": r_city, "memo": r_memo, "visited": False,
             }
             st.session_state['restaurants'].append(new_rest)
-            save_restaurants(st.session_state['restaurants'])
+            save_item_added("restaurants", new_rest)
             st.success(f"'{r_name}' 맛집이 추가되었습니다!")
             st.rerun()
         elif r_submitted:
@@ -2068,13 +4165,14 @@ with tab7:
                     with rc_check:
                         btn_label = "↩️ 방문 취소" if r.get('visited') else "✅ 방문 완료"
                         if st.button(btn_label, key=f"visit_{orig_i}", use_container_width=True):
-                            st.session_state['restaurants'][orig_i]['visited'] = not r.get('visited', False)
-                            save_restaurants(st.session_state['restaurants'])
+                            _visited = not r.get('visited', False)
+                            st.session_state['restaurants'][orig_i]['visited'] = _visited
+                            save_item_updated("restaurants", r['id'], {'visited': _visited})
                             st.rerun()
                     with rc_del:
                         if st.button("🗑️", key=f"del_rest_{orig_i}", use_container_width=True):
                             st.session_state['restaurants'].pop(orig_i)
-                            save_restaurants(st.session_state['restaurants'])
+                            save_item_removed("restaurants", r['id'])
                             st.rerun()
     else:
         st.info("아직 등록된 맛집이 없습니다. 가고 싶은 맛집을 추가해 보세요! 🍜")
@@ -0,0 +1,29 @@
+"""app.py는 Streamlit 스크립트라 import하면 화면까지 실행되므로, 테스트에 필요한 최상위 정의만 골라서 실행함."""
+import ast
+import os
+
+import pytest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+def _defined_name(node):
+    if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+        return node.name
+    if isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name):
+        return node.targets[0].id
+    return None
+
+
+@pytest.fixture
+def load_app():
+    """load_app(names, **namespace) → app.py에서 names에 해당하는 정의만 namespace 위에서 실행한 dict."""
+    with open(APP_PATH, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+
+    def _load(names, **namespace):
+        nodes = [n for n in tree.body if _defined_name(n) in names]
+        exec(compile(ast.Module(body=nodes, type_ignores=[]), APP_PATH, "exec"), namespace)
+        return namespace
+
+    return _load
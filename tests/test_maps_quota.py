@@ -0,0 +1,78 @@
+"""_maps_call 재시도와 QuotaGovernor 사용량 집계 테스트 (HTTP는 가짜 세션)."""
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import date as date_type
+
+import googlemaps
+import pytest
+
+NAMES = {
+    "MAPS_TIMEOUT_SEC", "MAPS_DEADLINE_SEC", "MAPS_RETRIES", "MAPS_RETRY_BASE_SEC",
+    "MapsUnavailable", "CircuitBreaker", "MapsQuotaExceeded", "QuotaGovernor",
+    "SingleAttemptMapsClient", "_request_units", "_is_retriable", "_maps_call",
+}
+
+API_KEY = "AIza" + "x" * 35
+
+
+class _Response:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self._body = body
+
+    def json(self):
+        return self._body
+
+
+class _FakeSession:
+    """정해 둔 응답을 순서대로 돌려주고 보낸 요청 수를 셈."""
+
+    def __init__(self, responses):
+        self._responses = list(responses)
+        self.requests = 0
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        return self._responses.pop(0)
+
+
+class _NoLimit:
+    def acquire(self):
+        pass
+
+
+@pytest.fixture
+def maps(load_app, tmp_path):
+    ns = load_app(
+        NAMES, googlemaps=googlemaps, os=__import__("os"), random=random, sqlite3=sqlite3,
+        threading=threading, time=time, deque=deque, date_type=date_type,
+    )
+    ns["MAPS_RETRY_BASE_SEC"] = 0.0
+    governor = ns["QuotaGovernor"](str(tmp_path / "quota.db"), {}, {})
+    breaker = ns["CircuitBreaker"](5, 30.0)
+    ns["_quota_governor"] = lambda: governor
+    ns["_maps_breaker"] = lambda endpoint: breaker
+    ns["_maps_rate_limiter"] = lambda: _NoLimit()
+    ns["governor"] = governor
+    return ns
+
+
+def test_every_http_request_is_counted_once(maps):
+    session = _FakeSession([
+        _Response(503),
+        _Response(500),
+        _Response(200, {"status": "OK", "results": [{"place_id": "p1"}]}),
+    ])
+    client = maps["SingleAttemptMapsClient"](
+        key=API_KEY, timeout=5, retry_timeout=maps["MAPS_TIMEOUT_SEC"], requests_session=session,
+    )
+
+    result = maps["_maps_call"](client.geocode, "Las Vegas")
+
+    assert result == [{"place_id": "p1"}]
+    # 라이브러리 내부 재시도 없이 _maps_call의 시도마다 HTTP 요청 하나, 사용량도 같은 수
+    assert session.requests == 3
+    assert maps["governor"].usage()["geocode"][0] == 3
@@ -0,0 +1,133 @@
+"""저장소 백엔드의 update_time 조회와 디스크 스냅샷 검증(_restore_from_disk), 쓰기 지연 큐 테스트."""
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import msgpack
+import pytest
+from firebase_admin import firestore
+
+NAMES = {
+    "TRAVEL_DOCS", "LEDGER_PREFIX", "STORAGE_TIMEOUT_SEC", "FirestoreStorage",
+    "SQLITE_ITEM_TABLES", "SQLITE_LEDGER_TABLE", "_sqlite_item_table", "SqliteStorage",
+    "_LIST_FIELDS", "_list_fields", "_merge_into", "SNAPSHOT_SAVE_DELAY_SEC",
+    "_pack_time", "_unpack_time", "DiskSnapshot", "TripDocCache", "_restore_from_disk",
+    "_fetch_into_cache", "SAVE_IDLE_SEC", "SAVE_MAX_DELAY_SEC", "SAVE_RETRY_MAX_SEC",
+    "_copy_patch", "_is_transform", "_combine_patches", "_MISSING", "_UNKNOWN",
+    "_encode_patch", "_decode_patch", "_patch_leaves", "_get_path", "_filter_patch",
+    "_diff_patch", "_epoch", "_resolve_op", "OPLOG_MARKS_DOC", "OpLog", "WriteBehindQueue",
+}
+
+
+@pytest.fixture
+def app(load_app, tmp_path):
+    """app.py에서 NAMES만 실행한 네임스페이스. _storage()는 ns['backend']를 돌려줌."""
+    ns = load_app(
+        NAMES, copy=copy, json=json, os=os, sqlite3=sqlite3, threading=threading,
+        time=time, uuid=uuid, datetime=datetime, msgpack=msgpack, firestore=firestore,
+    )
+    ns["_storage"] = lambda: ns["backend"]
+    ns["snapshot_path"] = str(tmp_path / "snapshot.msgpack")
+    ns["sqlite_path"] = str(tmp_path / "trip.db")
+    ns["oplog_path"] = str(tmp_path / "oplog.db")
+    return ns
+
+
+def _cache_with_snapshot(app, entries):
+    app["DiskSnapshot"](app["snapshot_path"]).save(entries)
+    cache = app["TripDocCache"]()
+    cache.disk = app["DiskSnapshot"](app["snapshot_path"])
+    return cache
+
+
+def test_sqlite_restore_from_disk_reuses_only_unchanged_docs(app):
+    backend = app["backend"] = app["SqliteStorage"](app["sqlite_path"])
+    backend.commit([("settings", {"departure": "2026-05-01"}, False), ("hotels", {"items": {}, "order": []}, False)])
+    snapshot = {d: (t, data) for d, data, t in backend.get_all(["settings", "hotels"])}
+    backend.commit([("hotels", {"order": ["h1"], "items": {"h1": {"name": "A"}}}, False)])
+
+    cache = _cache_with_snapshot(app, snapshot)
+    stale = app["_restore_from_disk"](cache, ["settings", "hotels", "places"])
+
+    assert sorted(stale) == ["hotels", "places"]
+    found, _, missing = cache.get_many(["settings", "hotels"])
+    assert found == {"settings": {"departure": "2026-05-01"}}
+    assert missing == ["hotels"]
+
+
+class _FakeSnapshot:
+    def __init__(self, doc_id, update_time):
+        self.id = doc_id
+        self.update_time = update_time
+
+
+class _FakeQuery:
+    def __init__(self, docs, fields):
+        self._docs = docs
+        self.fields = fields
+
+    def stream(self, timeout=None):
+        return (_FakeSnapshot(d, t) for d, (t, _) in self._docs.items())
+
+
+class _FakeCollection:
+    def __init__(self, db):
+        self._db = db
+
+    def select(self, field_paths):
+        self._db.selected.append(list(field_paths))
+        return _FakeQuery(self._db.docs, field_paths)
+
+
+class _FakeFirestore:
+    """get_update_times가 쓰는 collection().select().stream()만 흉내 냄."""
+
+    def __init__(self, docs):
+        self.docs = docs  # doc_id -> (update_time, data)
+        self.selected = []
+
+    def collection(self, name):
+        assert name == "travel_data"
+        return _FakeCollection(self)
+
+
+def test_firestore_restore_from_disk_checks_update_times(app):
+    t1 = datetime(2026, 10, 1, tzinfo=timezone.utc)
+    t2 = datetime(2026, 10, 2, tzinfo=timezone.utc)
+    db = _FakeFirestore({"settings": (t1, {"departure": "2026-05-01"}), "places": (t2, {"items": {}})})
+    backend = app["backend"] = object.__new__(app["FirestoreStorage"])
+    backend.db = db
+
+    assert backend.get_update_times(["settings"]) == {"settings": t1}
+    assert db.selected == [["__name__"]]
+
+    cache = _cache_with_snapshot(app, {"settings": (t1, {"departure": "2026-05-01"}), "places": (t1, {})})
+    stale = app["_restore_from_disk"](cache, ["settings", "places"])
+
+    assert stale == ["places"]
+    assert cache.get_many(["settings"])[0] == {"settings": {"departure": "2026-05-01"}}
+
+
+def test_merge_write_to_uncached_doc_stays_visible(app):
+    """처음 쓰는 월별 원장(캐시에 없는 문서)에 merge 저장해도 커밋 전후로 캐시에 항목이 보여야 함."""
+    backend = app["backend"] = app["SqliteStorage"](app["sqlite_path"])
+    cache = app["TripDocCache"]()
+    queue = app["WriteBehindQueue"](cache, app["OpLog"](app["oplog_path"]))
+    doc_id = app["LEDGER_PREFIX"] + "2026-05"
+
+    for expense_id in ("e1", "e2"):
+        queue.enqueue(doc_id, {
+            "items": {expense_id: {"amount": 10}},
+            "order": firestore.ArrayUnion([expense_id]),
+        }, merge=True)
+        app["_fetch_into_cache"](cache, [doc_id])  # 다음 실행의 load_ledger
+        queue.flush()
+
+    stored = backend.get_all([doc_id])[0][1]
+    assert stored["order"] == ["e1", "e2"]
+    assert cache.get_many([doc_id])[0][doc_id]["order"] == ["e1", "e2"]